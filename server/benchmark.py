@@ -0,0 +1,370 @@
+"""
+Offline benchmark of the extraction pipeline: POST /extract_questions followed by the
+worker's extract_data, with Gemini and Supabase replaced by in-process stand-ins.
+The fake model answers from outputs/*.json and simulates latency, streaming and errors.
+
+    python benchmark.py --documents 6 --concurrency 1,2,4 --latency 0.5 --error-rate 0.05 --truncate-rate 0.1
+
+Set EXTRACTION_MODE=schema to benchmark schema-constrained extraction.
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import uuid
+import base64
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import statistics
+from collections import defaultdict
+
+import fitz
+
+# everything the pipeline reads at import time has to point at throwaway local state
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_KEY", "benchmark")
+os.environ["RESULT_CACHE_BACKEND"] = "none"
+os.environ["JOB_QUEUE_BACKEND"] = "sqlite"
+os.environ["JOB_QUEUE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="benchmark_"), "jobs.sqlite3")
+# fake documents must not end up in the real search index
+os.environ["QUESTION_STORE_BACKEND"] = "none"
+os.environ["RATE_LIMIT_RPM"] = "1000000"
+os.environ["RATE_LIMIT_TPM"] = "1000000000"
+os.environ["SECTION_RETRY_BASE_SECONDS"] = "0.05"
+os.environ["JOB_RETRY_BASE_SECONDS"] = "0.1"
+
+from google.api_core import exceptions as google_exceptions
+
+stage_timings = defaultdict(list)
+
+def record(stage: str, started: float) -> None:
+    stage_timings[stage].append(time.perf_counter() - started)
+
+class SpanCollector(logging.Handler):
+    """Collects the stage spans config.metrics logs for every pipeline stage."""
+
+    def emit(self, record):
+        span = json.loads(record.getMessage())
+        stage_timings[span["name"]].append(span["duration_ms"] / 1000)
+
+
+# --- fake Gemini -------------------------------------------------------------
+
+class FakeUsage:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+    def __str__(self):
+        return f"prompt_token_count: {self.prompt_token_count} candidates_token_count: {self.candidates_token_count}"
+
+class FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int, chunk_count: int = 1, chunk_delay: float = 0.0):
+        self.text = text
+        self.parts = [text]
+        self.usage_metadata = FakeUsage(prompt_tokens, len(text) // 4)
+        self._chunk_count = chunk_count
+        self._chunk_delay = chunk_delay
+
+    async def __aiter__(self):
+        size = max(1, len(self.text) // self._chunk_count)
+        for start in range(0, len(self.text), size):
+            await asyncio.sleep(self._chunk_delay)
+            yield FakeChunk(self.text[start:start + size])
+
+class FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+        self.parts = [text]
+
+class FakeModel:
+    """Answers section identification and section extraction prompts from the outputs/ corpus."""
+
+    def __init__(self, corpus: list, latency: float, error_rate: float, chunks: int, truncate_rate: float = 0.0):
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chunks = chunks
+        self.truncate_rate = truncate_rate
+        # the rest of every cut-off answer, keyed by the part that was sent
+        self.remainders = {}
+
+    def _answer(self, contents):
+        if isinstance(contents[0], dict) and "role" in contents[0]:
+            # continuation request: user turn, the cut-off model turn, "continue"
+            partial_text = contents[1]["parts"][0]
+            return self.remainders.pop(partial_text, ""), len(partial_text) // 4
+        text, prompt_tokens = self._answer_prompt(contents)
+        if text.startswith("{\"section_title\"") and random.random() < self.truncate_rate:
+            cut = random.randrange(len(text) // 4, len(text))
+            self.remainders[text[:cut]] = text[cut:]
+            text = text[:cut]
+        return text, prompt_tokens
+
+    def _answer_prompt(self, contents):
+        prompt = next(part for part in reversed(contents) if isinstance(part, str))
+        pdfs = [base64.b64decode(part["data"]) for part in contents if isinstance(part, dict)]
+        prompt_tokens = len(prompt) // 4 + sum(258 * fitz.open(stream=pdf, filetype="pdf").page_count for pdf in pdfs)
+
+        if "IDENTIFY THE MAIN SECTIONS" in prompt:
+            return json.dumps(identify_sections_locally(pdfs[-1])), prompt_tokens
+
+        section_index = "ABC".index(re.search(r"(?:Section|Bahagian) ([ABC])", prompt).group(1))
+        paper = random.choice(self.corpus)
+        # papers stored without section headers get placeholders so schema mode can parse them
+        section = {
+            "section_title": {"malay": f"Bahagian {'ABC'[section_index]}"},
+            "instructions": {"malay": ""},
+            "section_marks": 0,
+            **paper[section_index]
+        }
+        return json.dumps(section, ensure_ascii=False), prompt_tokens
+
+    def _latency(self) -> float:
+        return random.expovariate(1 / self.latency) if self.latency else 0.0
+
+    def _maybe_fail(self):
+        if random.random() < self.error_rate:
+            raise google_exceptions.ServiceUnavailable("simulated model outage")
+
+    def generate_content(self, contents):
+        time.sleep(self._latency())
+        self._maybe_fail()
+        return FakeResponse(*self._answer(contents))
+
+    async def generate_content_async(self, contents, stream=False):
+        latency = self._latency()
+        await asyncio.sleep(latency / 2 if stream else latency)
+        self._maybe_fail()
+        text, prompt_tokens = self._answer(contents)
+        if stream:
+            return FakeResponse(text, prompt_tokens, self.chunks, latency / 2 / self.chunks)
+        return FakeResponse(text, prompt_tokens)
+
+def identify_sections_locally(pdf_content: bytes) -> dict:
+    """What the model is expected to answer for the identify-sections prompt."""
+    doc = fitz.open(stream=pdf_content, filetype="pdf")
+    first_line = doc[0].get_text().strip().split("\n")[0].strip()
+    first_page = int(first_line) if first_line.isdigit() else 1
+    starts = {}
+    for index, page in enumerate(doc):
+        for letter in re.findall(r"(?:Bahagian|Section) ([ABC])", page.get_text()):
+            starts.setdefault(letter, index + first_page)
+    doc.close()
+    return {"sections": starts, "first_page_number": first_page}
+
+
+# --- fake Supabase -----------------------------------------------------------
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+class FakeQuery:
+    def __init__(self, rows: dict, operation: str, payload=None):
+        self.rows = rows
+        self.operation = operation
+        self.payload = payload
+        self.filters = []
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def order(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args, **kwargs):
+        return self
+
+    def execute(self):
+        if self.operation == "insert":
+            row = {"id": str(uuid.uuid4()), "status": "in process", "data": None, **self.payload}
+            self.rows[row["id"]] = row
+            return FakeResult([row])
+        matches = [row for row in self.rows.values() if all(row.get(c) == v for c, v in self.filters)]
+        if self.operation == "update":
+            for row in matches:
+                row.update(self.payload)
+        return FakeResult(matches)
+
+class FakeTable:
+    def __init__(self, rows: dict):
+        self.rows = rows
+
+    def select(self, *args, **kwargs):
+        return FakeQuery(self.rows, "select")
+
+    def insert(self, payload):
+        return FakeQuery(self.rows, "insert", payload)
+
+    def update(self, payload):
+        return FakeQuery(self.rows, "update", payload)
+
+class FakeBucket:
+    def __init__(self, files: dict):
+        self.files = files
+
+    def upload(self, path, content, *args, **kwargs):
+        self.files[path] = content.read() if hasattr(content, "read") else bytes(content)
+
+    def download(self, path):
+        return self.files[path]
+
+    def exists(self, path):
+        return path in self.files
+
+    def remove(self, paths):
+        for path in paths:
+            self.files.pop(path, None)
+
+    def get_public_url(self, path):
+        return f"memory://files/{path}"
+
+class FakeStorage:
+    def __init__(self):
+        self.files = {}
+
+    def from_(self, bucket):
+        return FakeBucket(self.files)
+
+class FakeSupabase:
+    def __init__(self):
+        self.documents = {}
+        self.storage = FakeStorage()
+
+    def table(self, name):
+        return FakeTable(self.documents)
+
+
+# --- benchmark ---------------------------------------------------------------
+
+def load_corpus() -> list:
+    """Section lists of the stored papers (either {"sections": [...]} or the raw list extract_data writes)."""
+    corpus = []
+    for path in sorted(glob.glob("outputs/*.json")):
+        if path.endswith("temporary_output_data.json"):
+            continue
+        with open(path, encoding="utf-8") as f:
+            paper = json.load(f)
+        corpus.append(paper["sections"] if isinstance(paper, dict) else paper)
+    return corpus
+
+def install_fakes(model: FakeModel, supabase: FakeSupabase):
+    import db.init
+    db.init.create_client = lambda url, key: supabase
+
+    import config.ai_client
+    config.ai_client.get_model = lambda *args, **kwargs: model
+
+    import main
+    import modules.extraction as extraction
+    # the reference PDF is not part of the repository, so a one-page stand-in is sent inline
+    reference = fitz.open()
+    reference.new_page()
+    reference_part = config.ai_client.convert_pdf_to_part(reference.tobytes())
+    extraction.get_reference_pdf_part = lambda: reference_part
+
+    tracer = logging.getLogger("tracing")
+    tracer.setLevel(logging.INFO)
+    tracer.propagate = False
+    tracer.addHandler(SpanCollector())
+    return main
+
+async def run_level(main, supabase: FakeSupabase, pdf_content: bytes, documents: int, concurrency: int) -> dict:
+    from fastapi.testclient import TestClient
+    from modules.jobs import run_worker
+
+    client = TestClient(main.app)
+    document_ids = []
+    upload_started = time.perf_counter()
+    for i in range(documents):
+        started = time.perf_counter()
+        response = client.post(
+            "/extract_questions",
+            files={"pdf_file": (f"benchmark_{i}.pdf", pdf_content, "application/pdf")}
+        )
+        record("upload_request", started)
+        if response.status_code == 200:
+            document_ids.append(response.json()["data"]["document_id"])
+    upload_seconds = time.perf_counter() - upload_started
+
+    extraction_started = time.perf_counter()
+    worker = asyncio.create_task(run_worker(main.job_queue, supabase, None, concurrency, poll_interval=0.01))
+    while any(supabase.documents[document_id]["status"] == "in process" for document_id in document_ids):
+        await asyncio.sleep(0.01)
+    worker.cancel()
+    extraction_seconds = time.perf_counter() - extraction_started
+
+    statuses = [supabase.documents[document_id]["status"] for document_id in document_ids]
+    return {
+        "concurrency": concurrency,
+        "documents": documents,
+        "rejected": documents - len(document_ids),
+        "extracted": statuses.count("extracted"),
+        "failed": statuses.count("failed"),
+        "upload_seconds": upload_seconds,
+        "extraction_seconds": extraction_seconds,
+        "documents_per_second": len(document_ids) / extraction_seconds,
+    }
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def print_report(levels: list) -> None:
+    print("\nPer-stage latency (ms)")
+    print(f"{'stage':32} {'count':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'max':>9}")
+    for stage, values in sorted(stage_timings.items()):
+        ms = [value * 1000 for value in values]
+        print(f"{stage:32} {len(ms):>6} {statistics.mean(ms):>9.2f} {percentile(ms, 0.5):>9.2f} "
+              f"{percentile(ms, 0.95):>9.2f} {max(ms):>9.2f}")
+
+    print("\nThroughput")
+    print(f"{'concurrency':>11} {'docs':>5} {'rejected':>8} {'ok':>4} {'failed':>6} {'upload s':>9} {'extract s':>10} {'docs/s':>8}")
+    for level in levels:
+        print(f"{level['concurrency']:>11} {level['documents']:>5} {level['rejected']:>8} {level['extracted']:>4} {level['failed']:>6} "
+              f"{level['upload_seconds']:>9.2f} {level['extraction_seconds']:>10.2f} {level['documents_per_second']:>8.2f}")
+
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+    print(f"\nPeak RSS: {peak_rss_mb:.1f} MB")
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmarks the extraction pipeline against a fake model.")
+    parser.add_argument("--pdf", default="../client/public/sample-pdf.pdf", help="exam paper to upload")
+    parser.add_argument("--documents", type=int, default=6, help="uploads per concurrency level")
+    parser.add_argument("--concurrency", default="1,2,4", help="comma separated worker concurrency levels")
+    parser.add_argument("--latency", type=float, default=0.5, help="mean simulated model latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of model calls that fail")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="fraction of section answers that are cut off")
+    parser.add_argument("--chunks", type=int, default=8, help="streamed chunks per section response")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with open(args.pdf, "rb") as f:
+        pdf_content = f.read()
+
+    supabase = FakeSupabase()
+    model = FakeModel(load_corpus(), args.latency, args.error_rate, args.chunks, args.truncate_rate)
+    app_module = install_fakes(model, supabase)
+
+    levels = []
+    for concurrency in [int(value) for value in args.concurrency.split(",")]:
+        levels.append(asyncio.run(run_level(app_module, supabase, pdf_content, args.documents, concurrency)))
+    print_report(levels)
+
+if __name__ == "__main__":
+    run()
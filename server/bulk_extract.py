@@ -0,0 +1,130 @@
+"""
+Extracts every PDF in a directory to <output dir>/<name>.json, without the API, Supabase
+or the job queue (e.g. for nightly backfills):
+
+python bulk_extract.py papers/ --max-concurrency 4
+
+Papers whose output file exists are skipped, and a paper that was interrupted resumes from
+the sections it had finished (checkpoints are kept in cache/bulk_extract.sqlite3), so a
+failed run can simply be started again. Model calls go through the same rate limits as the
+workers (MAX_CONCURRENT_REQUESTS, RATE_LIMIT_RPM/TPM in .env).
+"""
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from dotenv import load_dotenv
+
+from modules.sections import locate_sections
+from modules.extraction import extract_sections
+from modules.jobs import SQLiteJobQueue
+from modules.questions import load_reference_structures
+from config.metrics import STAGE_SECONDS, SECTION_TOKENS
+
+# only the section checkpoint table of the job queue file is used; checkpoints are keyed
+# by PDF content, so one file serves every output directory
+PROGRESS_FILE = "cache/bulk_extract.sqlite3"
+
+
+async def extract_file(path: str, output_path: str, checkpoints, slots: asyncio.Semaphore) -> dict:
+    name = os.path.basename(path)
+    async with slots:
+        started = time.perf_counter()
+        try:
+            with open(path, "rb") as f:
+                pdf_content = f.read()
+            # checkpoints are keyed by content, so they survive renamed files
+            document_id = hashlib.sha256(pdf_content).hexdigest()
+            sections = await locate_sections(path, fair_key=document_id)
+            sections_data = await extract_sections(pdf_content, sections, document_id, checkpoints)
+
+            tmp_path = output_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as json_file:
+                json.dump({"sections": sections_data}, json_file, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, output_path)
+            await asyncio.to_thread(checkpoints.clear_checkpoints, document_id)
+            result = {"file": name, "status": "extracted", "sections": len(sections_data)}
+        except Exception as e:
+            print(f"{name} failed: {str(e)}")
+            result = {"file": name, "status": "failed", "error": str(e)}
+        result["seconds"] = time.perf_counter() - started
+        print(f"{name}: {result['status']} in {result['seconds']:.1f}s")
+        return result
+
+
+async def run_bulk(input_dir: str, output_dir: str, max_concurrency: int = 2, force: bool = False, pattern: str = "*.pdf",
+                   progress_file: str = PROGRESS_FILE) -> list:
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoints = SQLiteJobQueue(progress_file)
+    slots = asyncio.Semaphore(max_concurrency)
+
+    tasks = []
+    results = []
+    for path in sorted(glob.glob(os.path.join(input_dir, pattern))):
+        output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".json")
+        if os.path.exists(output_path) and not force:
+            results.append({"file": os.path.basename(path), "status": "skipped", "seconds": 0.0})
+            continue
+        tasks.append(extract_file(path, output_path, checkpoints, slots))
+    results += await asyncio.gather(*tasks)
+    return results
+
+
+def _histogram_totals(histogram, label: str) -> dict:
+    """{label value: (sum, count)} of a histogram recorded in this process."""
+    totals = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            if sample.name.endswith(("_sum", "_count")):
+                value_sum, count = totals.get(sample.labels[label], (0.0, 0))
+                if sample.name.endswith("_sum"):
+                    value_sum += sample.value
+                else:
+                    count += int(sample.value)
+                totals[sample.labels[label]] = (value_sum, count)
+    return totals
+
+
+def print_summary(results: list, wall_seconds: float) -> None:
+    print(f"\n{'file':40} {'status':>10} {'seconds':>9}")
+    for result in results:
+        print(f"{result['file'][:40]:40} {result['status']:>10} {result['seconds']:>9.1f}")
+    statuses = [result["status"] for result in results]
+    print(f"\n{statuses.count('extracted')} extracted, {statuses.count('skipped')} skipped, "
+          f"{statuses.count('failed')} failed in {wall_seconds:.1f}s")
+
+    stages = _histogram_totals(STAGE_SECONDS, "stage")
+    if stages:
+        print(f"\n{'stage':32} {'count':>6} {'total s':>9} {'mean s':>9}")
+        for name, (seconds, count) in sorted(stages.items()):
+            print(f"{name:32} {count:>6} {seconds:>9.2f} {seconds / max(count, 1):>9.2f}")
+
+    tokens = _histogram_totals(SECTION_TOKENS, "kind")
+    if tokens:
+        calls = tokens.get("prompt", (0, 0))[1]
+        print(f"\nmodel calls: {calls}, prompt tokens: {int(tokens.get('prompt', (0, 0))[0])}, "
+              f"candidate tokens: {int(tokens.get('candidates', (0, 0))[0])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extracts a directory of exam paper PDFs to JSON files.")
+    parser.add_argument("input_dir", help="directory with the PDFs")
+    parser.add_argument("--output-dir", default="outputs", help="where <name>.json files are written")
+    parser.add_argument("--max-concurrency", type=int, default=2, help="papers extracted at the same time")
+    parser.add_argument("--pattern", default="*.pdf", help="file name pattern inside input_dir")
+    parser.add_argument("--force", action="store_true", help="extract papers whose output already exists again")
+    parser.add_argument("--progress-file", default=PROGRESS_FILE, help="SQLite file with the checkpoints of unfinished papers")
+    args = parser.parse_args()
+
+    load_dotenv()
+    load_reference_structures()
+    started = time.perf_counter()
+    results = asyncio.run(run_bulk(
+        args.input_dir, args.output_dir, args.max_concurrency, args.force, args.pattern, args.progress_file
+    ))
+    print_summary(results, time.perf_counter() - started)
+    sys.exit(1 if any(result["status"] == "failed" for result in results) else 0)
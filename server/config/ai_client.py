@@ -1,21 +1,226 @@
 from google import genai
 import os
+import time
 import base64
+import asyncio
+import weakref
+import threading
+from contextlib import asynccontextmanager
+import fitz
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
-def configure_model():
-  genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-  return genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
-    generation_config={"response_mime_type": "application/json"},
-  )
-
-def get_ai_response(contents, response_schema=None, model="gemini-1.5-flash"):
-  model = configure_model()
-  response = model.generate_content(contents)
-  print(response.usage_metadata)
+from config.rate_limiter import get_scheduler, estimate_tokens, register_file_pages, forget_file_pages
+from config.metrics import stage, observe_usage, MODEL_WAIT_SECONDS, MODEL_CALLS
+
+DEFAULT_MODEL = "gemini-1.5-flash"
+DEFAULT_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+# a continuation is the rest of a JSON document, not valid JSON on its own
+CONTINUATION_GENERATION_CONFIG = {"response_mime_type": "text/plain"}
+
+# Process-wide client registry. genai.configure() is only called once, since every
+# call tears down the shared transport; GenerativeModel instances are cached per
+# (model name, generation config) and keep their underlying channels open.
+_registry_lock = threading.Lock()
+_configured = False
+_models = {}
+
+def _freeze(value):
+  if isinstance(value, dict):
+    return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+  if isinstance(value, (list, tuple)):
+    return tuple(_freeze(v) for v in value)
+  try:
+    hash(value)
+    return value
+  except TypeError:
+    return repr(value)
+
+def _ensure_configured():
+  global _configured
+  if _configured:
+    return
+  with _registry_lock:
+    if not _configured:
+      genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+      _configured = True
+
+def get_model(model_name=DEFAULT_MODEL, generation_config=None):
+  generation_config = generation_config or DEFAULT_GENERATION_CONFIG
+  key = (model_name, _freeze(generation_config))
+  model = _models.get(key)
+  if model is not None:
+    return model
+
+  _ensure_configured()
+  with _registry_lock:
+    if key not in _models:
+      _models[key] = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+    return _models[key]
+
+def to_response_schema(model_cls):
+  """
+  Converts a pydantic model into the OpenAPI subset Gemini accepts as response_schema:
+  refs are inlined, unions of objects are merged into one object, Optional becomes
+  nullable and recursive references are cut after their first level.
+  """
+  schema = model_cls.model_json_schema()
+  return _convert_schema(schema, schema.pop("$defs", {}))
+
+def _convert_schema(schema, defs, seen=()):
+  if "$ref" in schema:
+    name = schema["$ref"].split("/")[-1]
+    if name in seen:
+      return None
+    return _convert_schema(defs[name], defs, seen + (name,))
+
+  variants = schema.get("anyOf") or schema.get("oneOf")
+  if variants:
+    non_null = [variant for variant in variants if variant.get("type") != "null"]
+    converted = [c for c in (_convert_schema(variant, defs, seen) for variant in non_null) if c is not None]
+    if not converted:
+      return None
+    result = converted[0] if len(converted) == 1 else _merge_object_schemas(converted)
+    if len(non_null) < len(variants):
+      result = {**result, "nullable": True}
+    return result
+
+  if "const" in schema or "enum" in schema:
+    return {"type": "string", "enum": [str(value) for value in schema.get("enum", [schema.get("const")])]}
+
+  schema_type = schema.get("type")
+  if schema_type == "object":
+    properties = {}
+    for name, value in schema.get("properties", {}).items():
+      converted = _convert_schema(value, defs, seen)
+      if converted is not None:
+        properties[name] = converted
+    result = {"type": "object", "properties": properties}
+    required = [name for name in schema.get("required", []) if name in properties]
+    if required:
+      result["required"] = required
+    return result
+  if schema_type == "array":
+    items = _convert_schema(schema.get("items", {}), defs, seen)
+    return {"type": "array", "items": items} if items is not None else None
+  return {"type": schema_type or "string"}
+
+def _merge_object_schemas(schemas):
+  properties = {}
+  for schema in schemas:
+    for name, value in schema.get("properties", {}).items():
+      if name in properties and "enum" in value and "enum" in properties[name]:
+        properties[name] = {**value, "enum": sorted(set(properties[name]["enum"]) | set(value["enum"]))}
+      else:
+        properties.setdefault(name, value)
+  required = set.intersection(*(set(schema.get("required", [])) for schema in schemas))
+  merged = {"type": "object", "properties": properties}
+  if required:
+    merged["required"] = sorted(required)
+  return merged
+
+def _generation_config(response_schema=None):
+  if response_schema is None:
+    return DEFAULT_GENERATION_CONFIG
+  return {**DEFAULT_GENERATION_CONFIG, "response_schema": response_schema}
+
+# One set of semaphores per event loop: a process-wide cap plus a cap per model name.
+# Limits are read lazily so values from .env (loaded in main.py) are picked up.
+_limiters = weakref.WeakKeyDictionary()
+
+def _get_limiters(model):
+  loop = asyncio.get_running_loop()
+  limiters = _limiters.setdefault(loop, {})
+  if "__process__" not in limiters:
+    limiters["__process__"] = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_REQUESTS", 6)))
+  if model not in limiters:
+    limiters[model] = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_REQUESTS_PER_MODEL", 3)))
+  return limiters["__process__"], limiters[model]
+
+@asynccontextmanager
+async def concurrency_limit(model=DEFAULT_MODEL):
+  process_limiter, model_limiter = _get_limiters(model)
+  async with process_limiter, model_limiter:
+    yield
+
+@asynccontextmanager
+async def _scheduled_call(contents, model, fair_key=None, section=None):
+  """
+  Waits for rate budget (RPM/TPM) and a concurrency slot, then times the call as the
+  model_call stage. Yields a callback to report the response's usage.
+  """
+  scheduler = get_scheduler(model)
+  waiting_since = time.perf_counter()
+  estimated_tokens = await asyncio.to_thread(estimate_tokens, contents)
+  charged_tokens = await scheduler.acquire(estimated_tokens, fair_key)
+
+  def record_usage(response):
+    observe_usage(response.usage_metadata, section or "none")
+    scheduler.record_usage(estimated_tokens, charged_tokens, response.usage_metadata.prompt_token_count)
+
+  async with concurrency_limit(model):
+    MODEL_WAIT_SECONDS.labels(model=model).observe(time.perf_counter() - waiting_since)
+    try:
+      with stage("model_call", model=model, section=section, estimated_tokens=estimated_tokens):
+        yield record_usage
+      MODEL_CALLS.labels(model=model, outcome="success").inc()
+    except google_exceptions.ResourceExhausted:
+      MODEL_CALLS.labels(model=model, outcome="rate_limited").inc()
+      # quota exceeded despite the estimates: hold every call to this model back for a while
+      scheduler.pause(float(os.getenv("RATE_LIMIT_BACKOFF_SECONDS", 30)))
+      raise
+    except Exception:
+      MODEL_CALLS.labels(model=model, outcome="error").inc()
+      raise
+
+async def get_ai_response_async(contents, response_schema=None, model=DEFAULT_MODEL, fair_key=None, section=None):
+  async with _scheduled_call(contents, model, fair_key, section) as record_usage:
+    response = await get_model(model, _generation_config(response_schema)).generate_content_async(contents)
+  record_usage(response)
   return response
 
+async def stream_ai_response_async(contents, on_chunk, response_schema=None, model=DEFAULT_MODEL, fair_key=None, section=None):
+  """Like get_ai_response_async, but streams the generation and calls on_chunk(text) as it arrives."""
+  async with _scheduled_call(contents, model, fair_key, section) as record_usage:
+    response = await get_model(model, _generation_config(response_schema)).generate_content_async(contents, stream=True)
+    async for chunk in response:
+      if chunk.parts:
+        on_chunk(chunk.text)
+  record_usage(response)
+  return response
+
+async def continue_ai_response_async(contents, partial_text, prompt, model=DEFAULT_MODEL, fair_key=None, section=None):
+  """
+  Asks the model to carry on from partial_text, its own cut-off answer to contents,
+  and returns the response holding only the missing remainder.
+  """
+  conversation = [
+    {"role": "user", "parts": list(contents)},
+    {"role": "model", "parts": [partial_text]},
+    {"role": "user", "parts": [prompt]},
+  ]
+  async with _scheduled_call(conversation, model, fair_key, section) as record_usage:
+    response = await get_model(model, CONTINUATION_GENERATION_CONFIG).generate_content_async(conversation)
+  record_usage(response)
+  return response
+
+def upload_pdf(path):
+  """Uploads a PDF through the File API and returns the file handle."""
+  _ensure_configured()
+  uploaded = genai.upload_file(path, mime_type="application/pdf")
+  doc = fitz.open(path)
+  register_file_pages(uploaded.name, len(doc))
+  doc.close()
+  return uploaded
+
+def delete_pdf(uploaded):
+  """Deletes a File API upload once it is no longer needed. Best effort: files also expire on their own."""
+  forget_file_pages(uploaded.name)
+  try:
+    genai.delete_file(uploaded.name)
+  except Exception as e:
+    print(f"Failed to delete uploaded file {uploaded.name}: {str(e)}")
+
 def convert_pdf_to_part(pdf_file):
   pdf_content_base64 = base64.b64encode(pdf_file).decode("utf-8")
   return {"mime_type": "application/pdf", "data": pdf_content_base64}
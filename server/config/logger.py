@@ -1,5 +1,6 @@
 from datetime import datetime
 import json
+import os
 
 def log_json(json_data):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -28,8 +29,10 @@ def log_json(json_data):
     print(f"✅ Merged JSON saved to {json_log_name}")
 
 def log_error(error_message: str, response_text: str = None) -> None:
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # microseconds keep logs from concurrent section failures apart
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     error_log_name = f'error_logs/error_log_{timestamp}.txt'
+    os.makedirs('error_logs', exist_ok=True)
     
     with open(error_log_name, "w", encoding='utf-8') as f:
         f.write(f"Error: {error_message}\n\n")
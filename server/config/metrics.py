@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest, start_http_server
+)
+from prometheus_client import multiprocess
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+BYTE_BUCKETS = (64e3, 256e3, 1e6, 2.5e6, 5e6, 10e6, 25e6, 50e6)
+
+STAGE_SECONDS = Histogram(
+    "extraction_stage_seconds", "Time spent in each pipeline stage", ["stage"], buckets=STAGE_BUCKETS
+)
+SECTION_TOKENS = Histogram(
+    "extraction_section_tokens", "Prompt and candidate tokens per model call", ["section", "kind"], buckets=TOKEN_BUCKETS
+)
+MODEL_WAIT_SECONDS = Histogram(
+    "model_call_wait_seconds", "Time a model call waited for rate budget and a concurrency slot",
+    ["model"], buckets=STAGE_BUCKETS
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "job_queue_wait_seconds", "Time from enqueueing an extraction job to a worker claiming it", buckets=STAGE_BUCKETS
+)
+UPLOADED_BYTES = Histogram(
+    "upload_bytes", "Size of uploaded PDFs", buckets=BYTE_BUCKETS
+)
+MODEL_CALLS = Counter(
+    "model_calls_total", "Model calls by outcome", ["model", "outcome"]
+)
+
+# Trace ids tie the upload request to the worker that extracts it: the request starts a
+# trace (or continues an incoming `traceparent`), the id travels in the job payload, and
+# every stage is logged as a span with it.
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_span_id = contextvars.ContextVar("span_id", default=None)
+tracer = logging.getLogger("tracing")
+
+def configure_logging() -> None:
+    """
+    Sends log records to stderr at LOG_LEVEL (default WARNING). Spans are logged at INFO
+    on the "tracing" logger, so they are emitted unless TRACE_LOG is turned off.
+    """
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    if os.getenv("TRACE_LOG", "true").lower() in ("1", "true", "yes"):
+        tracer.setLevel(logging.INFO)
+    else:
+        tracer.disabled = True
+
+def start_trace(traceparent: str = None) -> str:
+    """Starts a trace for the current context, continuing a W3C `traceparent` header if given."""
+    parts = (traceparent or "").split("-")
+    trace_id = parts[1] if len(parts) == 4 and len(parts[1]) == 32 else uuid.uuid4().hex
+    _trace_id.set(trace_id)
+    _span_id.set(parts[2] if len(parts) == 4 else None)
+    return trace_id
+
+def current_trace_id() -> str:
+    return _trace_id.get()
+
+@contextmanager
+def stage(name: str, **attributes):
+    """Times a pipeline stage into extraction_stage_seconds and logs it as a span of the current trace."""
+    span_id = uuid.uuid4().hex[:16]
+    parent_token = _span_id.set(span_id)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        _span_id.reset(parent_token)
+        STAGE_SECONDS.labels(stage=name).observe(duration)
+        tracer.info(json.dumps({
+            "trace_id": _trace_id.get(),
+            "span_id": span_id,
+            "parent_span_id": _span_id.get(),
+            "name": name,
+            "duration_ms": round(duration * 1000, 3),
+            "error": error,
+            **attributes
+        }, ensure_ascii=False))
+
+def observe_usage(usage_metadata, section: str = "none") -> None:
+    SECTION_TOKENS.labels(section=section, kind="prompt").observe(usage_metadata.prompt_token_count or 0)
+    SECTION_TOKENS.labels(section=section, kind="candidates").observe(usage_metadata.candidates_token_count or 0)
+
+def render_metrics():
+    """Returns (body, content type) for a /metrics response, aggregating worker processes when
+    PROMETHEUS_MULTIPROC_DIR is set."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    from prometheus_client import REGISTRY
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+def serve_metrics(port: int) -> None:
+    """Exposes this process's metrics on their own port (used by worker processes)."""
+    start_http_server(port)
@@ -0,0 +1,142 @@
+import os
+import time
+import base64
+import asyncio
+import weakref
+from collections import OrderedDict, deque
+
+import fitz
+
+# Rough Gemini accounting: a PDF page costs about 258 input tokens, text about 4 characters
+# per token. Estimates are scaled by a per-model correction learned from usage_metadata.
+TOKENS_PER_PDF_PAGE = 258
+CHARS_PER_TOKEN = 4
+
+# page counts of files uploaded through the File API, keyed by file name
+_file_pages = {}
+
+def register_file_pages(file_name: str, pages: int) -> None:
+    _file_pages[file_name] = pages
+
+def forget_file_pages(file_name: str) -> None:
+    _file_pages.pop(file_name, None)
+
+def estimate_tokens(contents) -> int:
+    """Estimates the input tokens of a request from its PDF pages and prompt text."""
+    tokens = 0
+    for part in contents:
+        if isinstance(part, str):
+            tokens += len(part) // CHARS_PER_TOKEN + 1
+        elif isinstance(part, dict) and "parts" in part:
+            # a turn of a multi-turn conversation
+            tokens += estimate_tokens(part["parts"])
+        elif isinstance(part, dict) and part.get("mime_type") == "application/pdf":
+            doc = fitz.open(stream=base64.b64decode(part["data"]), filetype="pdf")
+            tokens += len(doc) * TOKENS_PER_PDF_PAGE
+            doc.close()
+        elif getattr(part, "name", None) in _file_pages:
+            tokens += _file_pages[part.name] * TOKENS_PER_PDF_PAGE
+    return tokens
+
+
+class TokenBucket:
+    """Bucket refilled continuously at `per_minute` units per minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+
+class ModelScheduler:
+    """
+    Admits calls for one model within its RPM and TPM budget. Waiting calls are grouped by
+    a fairness key (the document) and served round-robin, so one large paper cannot starve
+    the others.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.correction = 1.0
+        self.paused_until = 0.0
+        self._queues = OrderedDict()
+        self._dispatcher = None
+
+    async def acquire(self, estimated_tokens: int, fair_key=None) -> float:
+        """Waits for budget and returns the number of tokens charged."""
+        tokens = min(estimated_tokens * self.correction, self.tokens.capacity)
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(fair_key, deque()).append((waiter, tokens))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await waiter
+        return tokens
+
+    async def _dispatch(self) -> None:
+        while self._queues:
+            key, waiters = next(iter(self._queues.items()))
+            waiter, tokens = waiters[0]
+            if waiter.done():
+                # cancelled while waiting
+                waiters.popleft()
+                if not waiters:
+                    del self._queues[key]
+                continue
+
+            delay = max(
+                self.paused_until - time.monotonic(),
+                self.requests.wait_time(1),
+                self.tokens.wait_time(tokens)
+            )
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            waiters.popleft()
+            waiter.set_result(None)
+            if waiters:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+
+    def record_usage(self, estimated_tokens: int, charged_tokens: float, actual_tokens: int) -> None:
+        """Charges the difference between the estimate and the real prompt size, and learns from it."""
+        if not actual_tokens or not estimated_tokens:
+            return
+        self.tokens.take(actual_tokens - charged_tokens)
+        self.correction = 0.8 * self.correction + 0.2 * (actual_tokens / estimated_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """Stops admitting calls for a while, e.g. after the provider answered 429."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# one scheduler per (event loop, model); budgets are per process, so split the
+# provider quota across API and worker processes when setting these
+_schedulers = weakref.WeakKeyDictionary()
+
+def get_scheduler(model: str) -> ModelScheduler:
+    schedulers = _schedulers.setdefault(asyncio.get_running_loop(), {})
+    if model not in schedulers:
+        schedulers[model] = ModelScheduler(
+            float(os.getenv("RATE_LIMIT_RPM", 15)),
+            float(os.getenv("RATE_LIMIT_TPM", 1000000))
+        )
+    return schedulers[model]
@@ -1,24 +1,43 @@
-import json
+import os
+import time
+import uuid
+import asyncio
 from datetime import datetime
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, HTTPException, File, UploadFile, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
-from modules.sections import identify_sections
-from modules.questions import build_extract_section_data_prompt, validate_section_content
-from modules.sections import build_identify_sections_prompt, identify_sections
-from modules.utils import get_reference_pdf
+from modules.sections import locate_sections
+from modules.cache import init_cache, build_cache_key
+from modules.jobs import init_job_queue, index_questions
+from modules.question_store import (
+    init_question_store, LANGUAGES, LEVELS, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT
+)
+from modules.uploads import (
+    spool_form_files, check_content_length, extract_zip_pdfs, check_pdf, UploadRejected, form_files_openapi
+)
+from modules.assets import ASSET_BUCKET, ASSET_CACHE_SECONDS
+from modules.documents import (
+    DOCUMENT_STATUSES, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, LIST_COLUMNS, SECTION_LETTERS,
+    list_documents, section_index, build_skeleton, json_response, entries
+)
+from modules import events
 
-from config.logger import log_error
-from config.ai_client import get_ai_response, convert_pdf_to_part
+from config.metrics import stage, start_trace, render_metrics, configure_logging, UPLOADED_BYTES
 
 from db.init import init_db
 
 load_dotenv()
+configure_logging()
 
 app = FastAPI()
 supabase = init_db()
+result_cache = init_cache(supabase)
+job_queue = init_job_queue(supabase)
+question_store = init_question_store(supabase)
+events.add_sink(job_queue.add_event)
 
 origins = ["http://localhost:5173"]
 
@@ -30,85 +49,461 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/documents")
-def get_documents():
-    response = supabase.table("documents").select("*").order("uploaded_date", desc=True).execute()
-    return {
+def get_documents(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    status: str = None
+):
+    """One page of documents (newest first, listing columns only); pass next_cursor back for the next page."""
+    statuses = status.split(",") if status else None
+    unknown = [value for value in statuses or [] if value not in DOCUMENT_STATUSES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown status: {', '.join(unknown)}")
+    documents, next_cursor = list_documents(supabase, limit, cursor, statuses)
+    return json_response(request, {
         "status": "success",
         "message": "Documents fetched successfully",
         "data": {
-            "documents": response.data
+            "documents": documents,
+            "next_cursor": next_cursor
         }
-    }
+    })
 
 @app.get("/documents/{id}")
-def get_document_by_id(id: str):
+def get_document_by_id(id: str, request: Request):
     response = supabase.table("documents").select("*").eq("id", id).execute()
     if not response.data:
         raise HTTPException(status_code=404, detail="Document not found")
-    return {
+    return json_response(request, {
         "status": "success",
         "message": "Document fetched successfully",
         "data": response.data[0]
-    }
+    })
 
-@app.post("/extract_questions")
-async def analyse_pdf(background_tasks: BackgroundTasks, pdf_file: UploadFile = File(...)):
+@app.get("/documents/{id}/skeleton")
+def get_document_skeleton(id: str, request: Request):
+    """The document without question content: sections, main question numbers and marks."""
+    response = supabase.table("documents").select(f"{LIST_COLUMNS}, data").eq("id", id).execute()
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Document not found")
+    document = response.data[0]
+    document["sections"] = build_skeleton(document.pop("data"))
+    return json_response(request, {
+        "status": "success",
+        "message": "Document skeleton fetched successfully",
+        "data": document
+    })
+
+def _get_section(id: str, section: str) -> dict:
     try:
-        if not pdf_file.filename.endswith(".pdf"):
-            raise HTTPException(status_code=400, detail="Input PDF file must end with .pdf")
+        index = section_index(section)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    # only this section of the data column is read from the database
+    response = supabase.table("documents").select(f"section:data->{index}").eq("id", id).execute()
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not response.data[0]["section"]:
+        raise HTTPException(status_code=404, detail=f"Section {section} has not been extracted")
+    return response.data[0]["section"]
 
-        user_pdf_content = await pdf_file.read()
-        pdf = convert_pdf_to_part(user_pdf_content)
+@app.get("/documents/{id}/sections/{section}")
+def get_document_section(id: str, section: str, request: Request):
+    return json_response(request, {
+        "status": "success",
+        "message": "Section fetched successfully",
+        "data": _get_section(id, section)
+    })
 
-        print("Identifying sections...")
-        indentify_sections_prompt = build_identify_sections_prompt()
-        sections_response = get_ai_response([pdf, indentify_sections_prompt])
-        sections_response_json = json.loads(sections_response.text)
-        sections = await identify_sections(sections_response_json, user_pdf_content)
+@app.get("/documents/{id}/sections/{section}/questions/{number}")
+def get_document_main_question(id: str, section: str, number: str, request: Request):
+    # older extractions stored main question numbers as strings
+    main_question = next(
+        (question for question in entries(_get_section(id, section).get("main_questions")) if str(question.get("number")) == number),
+        None
+    )
+    if main_question is None:
+        raise HTTPException(status_code=404, detail=f"Question {number} not found in section {section}")
+    return json_response(request, {
+        "status": "success",
+        "message": "Question fetched successfully",
+        "data": main_question
+    })
 
-        unique_id = datetime.now().strftime("%Y%m%d%H%M%S") + '_' + pdf_file.filename.lower().replace(" ", "_")
-        supabase.storage.from_("files").upload(unique_id, user_pdf_content)
-        download_link = supabase.storage.from_("files").get_public_url(unique_id)
+@app.get("/questions/search")
+def search_questions(
+    request: Request,
+    q: str = None,
+    language: str = None,
+    min_marks: int = None,
+    max_marks: int = None,
+    section: str = None,
+    level: str = None,
+    document_id: str = None,
+    has_diagram: bool = None,
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT)
+):
+    """
+    Questions across all extracted papers: full-text search (q) in the Malay or English
+    text (language, both by default), filtered by marks, section (A, B, C), level
+    (main_question, question, sub_question), document and whether a diagram or table is referenced.
+    """
+    if question_store is None:
+        raise HTTPException(status_code=503, detail="Question search is disabled (QUESTION_STORE_BACKEND=none)")
+    if language is not None and language not in LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"language must be one of: {', '.join(LANGUAGES)}")
+    if level is not None and level not in LEVELS:
+        raise HTTPException(status_code=400, detail=f"level must be one of: {', '.join(LEVELS)}")
+    if section is not None:
+        try:
+            section = SECTION_LETTERS[section_index(section)]
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-        # insert document and get the inserted record's ID
-        insert_response = supabase.table("documents").insert({"file_name": pdf_file.filename, "file_url": download_link}).execute()
-        document_id = insert_response.data[0]['id']
+    questions = question_store.search(
+        q, language, min_marks, max_marks, section, level, document_id, has_diagram, limit
+    )
+    # results name their paper
+    document_ids = list({question["document_id"] for question in questions})
+    if document_ids:
+        response = supabase.table("documents").select("id, file_name").in_("id", document_ids).execute()
+        file_names = {row["id"]: row["file_name"] for row in response.data}
+        for question in questions:
+            question["file_name"] = file_names.get(question["document_id"])
+    return json_response(request, {
+        "status": "success",
+        "message": "Questions fetched successfully",
+        "data": {"questions": questions}
+    })
 
-        background_tasks.add_task(extract_data, pdf, sections, document_id)
+@app.get("/documents/{id}/stream")
+async def stream_document(id: str):
+    """Server-Sent Events with the extraction progress of a document."""
+    recorded = await asyncio.to_thread(job_queue.get_events, id)
+    if not recorded:
+        # nothing recorded for this document: report the stored state and stop
+        response = await asyncio.to_thread(supabase.table("documents").select("status, data").eq("id", id).execute)
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Document not found")
+        document = response.data[0]
+        event = {"extracted": "completed", "edited": "completed", "failed": "failed"}.get(document["status"], "status")
+        message = {"event": event, "data": {"status": document["status"], "data": document["data"]}}
 
-        return {
-            "status": "success", 
-            "message": "File uploaded successfully. Please wait while it being processed.", 
-            "data": { "document_id": document_id, "file_url": download_link }
-        }
+        async def stored_state():
+            yield events.format_sse(message)
+        return StreamingResponse(stored_state(), media_type="text/event-stream")
+
+    async def recorded_events():
+        async for message in events.poll(job_queue.get_events, id, events.latest_run_start(recorded)):
+            yield events.format_sse(message)
+
+    return StreamingResponse(
+        recorded_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/documents/{id}/assets/{name:path}")
+async def get_document_asset(id: str, name: str, request: Request):
+    """
+    A pre-rendered diagram or table (WebP), by the name it has in the extracted data.
+    Names may contain "/" (e.g. "Rajah 1 / Diagram 1"), so the rest of the path is the name.
+    """
+    response = await asyncio.to_thread(supabase.table("documents").select("assets").eq("id", id).execute)
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Document not found")
+    path = (response.data[0].get("assets") or {}).get(name)
+    if not path:
+        raise HTTPException(status_code=404, detail=f"No rendered asset named '{name}'")
+
+    # the storage path is a content hash, so it doubles as a strong ETag
+    headers = {"ETag": f'"{os.path.basename(path)}"', "Cache-Control": f"public, max-age={ASSET_CACHE_SECONDS}, immutable"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    content = await asyncio.to_thread(supabase.storage.from_(ASSET_BUCKET).download, path)
+    return Response(content=content, media_type="image/webp", headers=headers)
+
+@app.post("/documents/{id}/resume")
+def resume_document(id: str, request: Request):
+    """Re-queues a failed extraction; sections that already succeeded are kept."""
+    response = supabase.table("documents").select("status").eq("id", id).execute()
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if response.data[0]["status"] != "failed":
+        raise HTTPException(status_code=409, detail=f"Only failed documents can be resumed (status is '{response.data[0]['status']}')")
+
+    job = job_queue.get_latest_job(id)
+    if not job:
+        raise HTTPException(status_code=409, detail="No extraction job found for this document")
+
+    # only the request that moves the document out of 'failed' queues a job
+    updated = supabase.table("documents").update({"status": "in process"}).eq("id", id).eq("status", "failed").execute()
+    if not updated.data:
+        raise HTTPException(status_code=409, detail="Document is already being resumed")
+
+    completed_sections = list(job_queue.get_checkpoints(id))
+    events.publish(id, "resumed", {"completed_sections": completed_sections})
+    trace_id = start_trace(request.headers.get("traceparent"))
+    job_queue.enqueue(id, {
+        **job["payload"],
+        "traceparent": f"00-{trace_id}-{uuid.uuid4().hex[:16]}-01",
+        "enqueued_at": time.time()
+    })
+
+    return {
+        "status": "success",
+        "message": "Extraction resumed. Only the missing sections will be processed.",
+        "data": {"document_id": id, "completed_sections": completed_sections}
+    }
 
+@app.post("/extract_questions", openapi_extra=form_files_openapi("pdf_file"))
+async def analyse_pdf(request: Request):
+    """Takes one paper as the `pdf_file` field of a multipart form."""
+    trace_id = start_trace(request.headers.get("traceparent"))
+    max_bytes = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+
+    def file_limits(file_name: str):
+        if not file_name.endswith(".pdf"):
+            raise UploadRejected(400, "Input PDF file must end with .pdf")
+        return max_bytes, "pdf"
+
+    try:
+        # a declared size is checked before anything is read; the body is then streamed
+        # to disk as it arrives and only ever read from there
+        check_content_length(request, max_bytes)
+        uploads = await spool_form_files(request, "pdf_file", file_limits)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    if len(uploads) != 1:
+        for _, upload in uploads:
+            os.remove(upload["path"])
+        raise HTTPException(status_code=400, detail="Send exactly one PDF as pdf_file")
+    file_name, upload = uploads[0]
+    try:
+        return await _analyse_spooled_pdf(file_name, upload, trace_id)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail={"status": "error", "message": str(e), "data": None})
+    finally:
+        os.remove(upload["path"])
+
+@app.post("/extract_questions/batch", openapi_extra=form_files_openapi("pdf_files", multiple=True))
+async def analyse_pdf_batch(request: Request):
+    """
+    Takes many papers at once, as PDFs and/or zip archives of PDFs (the `pdf_files` field of
+    a multipart form). Identical papers are extracted once; all of them are queued under one
+    batch id whose progress is at GET /batches/{id}.
+    """
+    trace_id = start_trace(request.headers.get("traceparent"))
+    max_bytes = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+    max_files = int(os.getenv("MAX_BATCH_FILES", 50))
+    batch_id = str(uuid.uuid4())
+    uploads = []
+    spooled = []
+    received = []
 
-def extract_data(pdf, sections, document_id: str):
-    reference_pdf_content = get_reference_pdf()
-    reference_pdf = convert_pdf_to_part(reference_pdf_content)
+    def file_limits(file_name: str):
+        received.append(file_name)
+        if len(received) > max_files:
+            raise UploadRejected(413, f"At most {max_files} PDFs are accepted per batch")
+        if file_name.lower().endswith(".zip"):
+            return max_bytes * max_files, "zip"
+        if file_name.lower().endswith(".pdf"):
+            return max_bytes, "pdf"
+        raise UploadRejected(400, f"{file_name}: only .pdf and .zip files are accepted")
 
-    print("Extracting data from sections...")
-    sections_data = []
-    for section in sections:
-        print(f"Processing section: {section['name']}")
-        prompt = build_extract_section_data_prompt(section)
+    try:
         try:
-            response = get_ai_response([reference_pdf, pdf, prompt])
-            validate_section_content(response.text, section['name'])
-            print(response.text)
-            response_json = json.loads(response.text)
-            sections_data.append(response_json)
-        except Exception as e:
-            print(f"Error in extract_section_data: {str(e)}")
-            supabase.table("documents").update({"status": "failed"}).eq("id", document_id).execute()
-            log_error(str(e), response.text if 'response' in locals() else None)
-            raise ValueError(f"Error extracting section data: {str(e)}")
-    
-    supabase.table("documents").update({"data": sections_data, "status": "extracted"}).eq("id", document_id).execute()
-
-    with open("outputs/temporary_output_data.json", "w", encoding="utf-8") as json_file:
-        json.dump(sections_data, json_file, ensure_ascii=False, indent=4)
-    return {"status": "Success", "data": sections_data}
+            check_content_length(request, max_bytes * max_files)
+            uploads = await spool_form_files(request, "pdf_files", file_limits)
+            if not uploads:
+                raise UploadRejected(400, "No files were sent as pdf_files")
+            while uploads:
+                file_name, upload = uploads.pop(0)
+                if not file_name.lower().endswith(".zip"):
+                    spooled.append((file_name, upload))
+                    continue
+                try:
+                    spooled += await asyncio.to_thread(extract_zip_pdfs, upload["path"], max_bytes, max_files)
+                finally:
+                    os.remove(upload["path"])
+            if len(spooled) > max_files:
+                raise UploadRejected(413, f"At most {max_files} PDFs are accepted per batch")
+        except UploadRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        finally:
+            # files received but not yet moved to spooled (after an error in a zip)
+            for _, upload in uploads:
+                os.remove(upload["path"])
+
+        # identical papers (e.g. the same file in two archives) are extracted once
+        originals = {}
+        for file_name, upload in spooled:
+            originals.setdefault(upload["sha256"], (file_name, upload))
+        # bounds the uploads and section detection running at once; extraction itself
+        # goes through the job queue and the shared model call scheduler
+        slots = asyncio.Semaphore(int(os.getenv("BATCH_SUBMIT_CONCURRENCY", 4)))
+
+        async def submit(file_name: str, upload: dict) -> dict:
+            async with slots:
+                try:
+                    response = await _analyse_spooled_pdf(file_name, upload, trace_id, batch_id)
+                except Exception as e:
+                    return {"status": "rejected", "error": str(e)}
+            cached = "extracted_data" in response["data"]
+            return {"status": "extracted" if cached else "queued", "document_id": response["data"]["document_id"]}
+
+        results = await asyncio.gather(*(submit(*original) for original in originals.values()))
+        submitted = dict(zip(originals, results))
+        files = []
+        for file_name, upload in spooled:
+            original_name, original = originals[upload["sha256"]]
+            entry = {"file_name": file_name, **submitted[upload["sha256"]]}
+            if original is not upload:
+                entry["duplicate_of"] = original_name
+            files.append(entry)
+    finally:
+        for _, upload in spooled:
+            os.remove(upload["path"])
+
+    return {
+        "status": "success",
+        "message": f"{len(originals)} papers submitted ({len(spooled) - len(originals)} duplicates skipped).",
+        "data": {"batch_id": batch_id, "files": files}
+    }
+
+@app.get("/batches/{id}")
+async def get_batch(id: str, request: Request):
+    """Aggregate progress of a batch: document statuses and sections extracted so far."""
+    response = await asyncio.to_thread(
+        supabase.table("documents").select("id, file_name, status").eq("batch_id", id).execute
+    )
+    if not response.data:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    documents = response.data
+
+    async def sections_done(document: dict) -> int:
+        if document["status"] in ("extracted", "edited"):
+            return len(SECTION_LETTERS)
+        recorded = await asyncio.to_thread(job_queue.get_events, document["id"])
+        run_start = events.latest_run_start(recorded)
+        return len({
+            message["data"]["section"] for event_id, message in recorded
+            if event_id > run_start and message["event"] == "section_done"
+        })
+
+    for document, done in zip(documents, await asyncio.gather(*(sections_done(document) for document in documents))):
+        document["sections_done"] = done
+    statuses = [document["status"] for document in documents]
+    sections_total = len(SECTION_LETTERS) * len(documents)
+    return json_response(request, {
+        "status": "success",
+        "message": "Batch fetched successfully",
+        "data": {
+            "batch_id": id,
+            "documents": documents,
+            "counts": {status: statuses.count(status) for status in DOCUMENT_STATUSES},
+            "sections_done": sum(document["sections_done"] for document in documents),
+            "sections_total": sections_total,
+            "finished": all(status in ("extracted", "edited", "failed") for status in statuses)
+        }
+    })
+
+async def _analyse_spooled_pdf(file_name: str, upload: dict, trace_id: str, batch_id: str = None):
+    pdf_path = upload["path"]
+    UPLOADED_BYTES.observe(upload["size"])
+    await asyncio.to_thread(check_pdf, pdf_path, int(os.getenv("MAX_UPLOAD_PAGES", 100)))
+
+    # identical PDFs (same prompts, references and model) reuse the stored extraction
+    cache_key = build_cache_key(upload["sha256"])
+    cached = await asyncio.to_thread(result_cache.get, cache_key) if result_cache else None
+
+    # blocking client calls run in threads and the storage upload overlaps section
+    # identification, so one slow request does not hold up the event loop
+    unique_id = datetime.now().strftime("%Y%m%d%H%M%S") + '_' + file_name.lower().replace(" ", "_")
+    if batch_id:
+        # papers of one batch are uploaded within the same second
+        unique_id = f"{unique_id[:-4]}_{upload['sha256'][:8]}.pdf"
+    batch = {"batch_id": batch_id} if batch_id else {}
+
+    def upload_spooled_file():
+        # the storage client streams an open file instead of holding it in memory
+        with open(pdf_path, "rb") as pdf_stream:
+            supabase.storage.from_("files").upload(unique_id, pdf_stream)
+
+    async def upload_pdf_file():
+        with stage("storage_upload", bytes=upload["size"]):
+            await asyncio.to_thread(upload_spooled_file)
+        return supabase.storage.from_("files").get_public_url(unique_id)
+
+    async def find_sections():
+        if cached:
+            print("Using cached extraction")
+            return cached["sections"]
+        return await locate_sections(pdf_path, fair_key=batch_id or unique_id)
+
+    download_link, sections = await asyncio.gather(upload_pdf_file(), find_sections(), return_exceptions=True)
+    if isinstance(sections, Exception) or isinstance(download_link, Exception):
+        if not isinstance(download_link, Exception):
+            # do not leave the upload of a rejected PDF behind in storage
+            await asyncio.to_thread(supabase.storage.from_("files").remove, [unique_id])
+        raise sections if isinstance(sections, Exception) else download_link
+
+    if cached:
+        insert_response = await asyncio.to_thread(supabase.table("documents").insert({
+            "file_name": file_name,
+            "file_url": download_link,
+            "data": cached["data"],
+            "status": "extracted",
+            **batch,
+            # renders are keyed by content, so the stored ones serve this copy too
+            **({"assets": cached["assets"]} if cached.get("assets") else {})
+        }).execute)
+        document_id = insert_response.data[0]['id']
+        await asyncio.to_thread(events.publish, document_id, "sections_identified", sections)
+        await asyncio.to_thread(events.publish, document_id, "completed", {"status": "extracted", "data": cached["data"]})
+        await index_questions(question_store, document_id, cached["data"])
+        return {
+            "status": "success",
+            "message": "File uploaded successfully. Extracted data was found in cache.",
+            "data": {
+                "document_id": document_id,
+                "file_url": download_link,
+                "sections": sections,
+                "extracted_data": cached["data"]
+            }
+        }
+
+    # insert document and get the inserted record's ID
+    with stage("db_write"):
+        insert_response = await asyncio.to_thread(
+            supabase.table("documents").insert({"file_name": file_name, "file_url": download_link, **batch}).execute
+        )
+    document_id = insert_response.data[0]['id']
+    await asyncio.to_thread(events.publish, document_id, "sections_identified", sections)
+
+    # extraction runs in worker processes (see worker.py); the PDF is read back from storage
+    await asyncio.to_thread(job_queue.enqueue, document_id, {
+        "storage_path": unique_id,
+        "sections": sections,
+        "cache_key": cache_key,
+        # a batch shares one fair share of the model's rate budget with other uploads
+        "fair_key": batch_id,
+        "traceparent": f"00-{trace_id}-{uuid.uuid4().hex[:16]}-01",
+        "enqueued_at": time.time()
+    })
+
+    return {
+        "status": "success", 
+        "message": "File uploaded successfully. Please wait while it being processed.", 
+        "data": { "document_id": document_id, "file_url": download_link }
+    }
+
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional, Literal
+from pydantic import BaseModel, Field
+from typing import List, Optional, Literal, Union, Annotated
 from enum import Enum
 
 class ContentType(str, Enum):
@@ -33,7 +33,7 @@ class Diagram(ContentFlowItem):
 class Row(ContentFlowItem):
     type: Literal[ContentType.ROW]
     layout: str
-    items: List["ContentFlowItem"] 
+    items: List["ContentFlowEntry"]
 
 class Table(ContentFlowItem):
     type: Literal[ContentType.TABLE]
@@ -53,23 +53,29 @@ class TypeQuestion(ContentFlowItem):
     type: Literal[ContentType.QUESTION]
     number: str
 
+# a content_flow entry is parsed into the concrete item class picked by its "type"
+ContentFlowEntry = Annotated[
+    Union[Text, Diagram, Row, Table, AnswerSpace, TypeSubQuestion, TypeQuestion],
+    Field(discriminator="type")
+]
+
 # enable automatic resolution of forward references
-ContentFlowItem.model_rebuild()
+Row.model_rebuild()
 
 class SubQuestion(BaseModel):
     number: str
     marks: Optional[int] = None
-    content_flow: List[ContentFlowItem]
+    content_flow: List[ContentFlowEntry]
 
 class Question(BaseModel):
     number: str
     marks: Optional[int] = None
-    content_flow: List[ContentFlowItem]
+    content_flow: List[ContentFlowEntry]
     sub_questions: Optional[List[SubQuestion]] = None
 
 class MainQuestion(BaseModel):
     number: int
-    content_flow: List[ContentFlowItem]
+    content_flow: List[ContentFlowEntry]
     questions: List[Question]
 
 class Section(BaseModel):
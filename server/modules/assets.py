@@ -0,0 +1,237 @@
+import os
+import re
+import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+# bump when the cropping or encoding changes so stale renders are not reused
+ASSETS_VERSION = "1"
+ASSET_BUCKET = "files"
+ASSET_PREFIX = "assets"
+# object keys are content hashes, so a stored render never changes
+ASSET_CACHE_SECONDS = 31536000
+
+# running headers and footers are never part of a diagram or table
+HEADER_FRACTION = 0.08
+FOOTER_FRACTION = 0.93
+# visuals that start this close to the caption belong to it
+CAPTION_REACH = 72
+# gap bridged when growing a region over neighbouring drawings and labels
+REGION_GAP = 12
+REGION_PADDING = 6
+# short text (axis labels, part letters) next to a visual is cropped with it
+LABEL_MAX_CHARS = 20
+
+_CAPTION_WORDS = {"diagram": "rajah", "table": "jadual"}
+_CAPTION = re.compile(r"(rajah|jadual)\d+(\.\d+)*(\([a-z]\))?$")
+_pool = None
+
+
+def _normalize(name: str) -> str:
+    """Caption text without spaces or case: "Rajah 5.1 (a)", "rajah 5.1(a)" and "Diagram 5.1(a)" compare equal."""
+    text = re.sub(r"\s+", "", name).lower()
+    for english, malay in _CAPTION_WORDS.items():
+        if text.startswith(english):
+            return malay + text[len(english):]
+    return text
+
+
+def collect_assets(sections_data: list, page_offset: int = 0) -> list:
+    """
+    Lists the diagrams and tables referenced in extracted sections as
+    (name, page index) pairs, once per name, in document order.
+    """
+    assets = {}
+
+    def walk(data):
+        if isinstance(data, dict):
+            if data.get("type") in ("diagram", "table") and data.get("name") and isinstance(data.get("page"), int):
+                assets.setdefault(data["name"], data["page"] - page_offset - 1)
+            for value in data.values():
+                walk(value)
+        elif isinstance(data, list):
+            for item in data:
+                walk(item)
+
+    walk(sections_data)
+    return list(assets.items())
+
+
+def asset_key(pdf_hash: str, name: str, page_index: int, dpi: int) -> str:
+    digest = hashlib.sha256(f"{pdf_hash}:{page_index}:{name}:{dpi}:{ASSETS_VERSION}".encode()).hexdigest()
+    return f"{ASSET_PREFIX}/{digest}.webp"
+
+
+def find_asset_region(page, name: str):
+    """
+    Finds the area of a diagram or table on a page: the images and drawings next to its
+    caption (above it first, then below), grown over touching drawings and short labels,
+    plus the caption itself. Falls back to the page body when no visuals are near the
+    caption; returns None when the caption is not on the page.
+    """
+    top = page.rect.height * HEADER_FRACTION
+    bottom = page.rect.height * FOOTER_FRACTION
+    body = fitz.Rect(page.rect.x0, top, page.rect.x1, bottom)
+
+    # names may carry both languages, e.g. "Rajah 1 / Diagram 1"
+    wanted = {_normalize(part) for part in name.split("/")}
+    captions = []
+    others = []
+    labels = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"]:
+        for line in block.get("lines", []):
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            rect = fitz.Rect(line["bbox"])
+            if not text or rect.y1 <= top or rect.y0 >= bottom:
+                continue
+            # the caption is the line that is only the name (its English line normalizes
+            # the same); mentions in sentences are skipped
+            if _normalize(text) in wanted:
+                captions.append(rect)
+            elif _CAPTION.match(_normalize(text)):
+                others.append(rect)
+            elif len(text) <= LABEL_MAX_CHARS:
+                labels.append(rect)
+    if not captions:
+        return None
+    caption = fitz.Rect(captions[0])
+    for rect in captions[1:]:
+        if abs(rect.y0 - caption.y1) <= REGION_GAP * 2:
+            caption |= rect
+
+    visuals = [fitz.Rect(info["bbox"]) for info in page.get_image_info()]
+    visuals += [fitz.Rect(drawing["rect"]) for drawing in page.get_cdrawings()]
+    # thin rules have no area; widen them so they still join a region
+    visuals = [
+        rect + (-1, -1, 1, 1) for rect in visuals
+        if rect.y1 > top and rect.y0 < bottom and not (rect.width > body.width * 0.9 and rect.height > body.height * 0.9)
+    ]
+
+    for above in (True, False):
+        if above:
+            side = [rect for rect in visuals if rect.y0 < caption.y0]
+            seeds = [rect for rect in side if caption.y0 - rect.y1 <= CAPTION_REACH]
+        else:
+            side = [rect for rect in visuals if rect.y1 > caption.y1]
+            seeds = [rect for rect in side if rect.y0 - caption.y1 <= CAPTION_REACH]
+        # side by side visuals each have their own caption underneath
+        columns = [rect for rect in seeds if rect.x0 - REGION_GAP < caption.x1 and rect.x1 + REGION_GAP > caption.x0]
+        seeds = columns or seeds
+        if not seeds:
+            continue
+
+        region = fitz.Rect(seeds[0])
+        for rect in seeds[1:]:
+            region |= rect
+        candidates = [rect for rect in side if rect not in seeds]
+        candidates += [rect for rect in labels if (rect.y1 <= caption.y0 if above else rect.y0 >= caption.y1)]
+        grown = True
+        while grown:
+            grown = False
+            reach = region + (-REGION_GAP, -REGION_GAP, REGION_GAP, REGION_GAP)
+            for rect in candidates:
+                if rect.intersects(reach) and not region.contains(rect):
+                    region |= rect
+                    grown = True
+        region |= caption
+        # captions on the same row split a shared picture between them
+        for other in others:
+            if other.y0 < caption.y1 and other.y1 > caption.y0:
+                middle = (other.x1 + caption.x0) / 2 if other.x1 <= caption.x0 else (caption.x1 + other.x0) / 2
+                if other.x1 <= caption.x0:
+                    region.x0 = max(region.x0, middle)
+                else:
+                    region.x1 = min(region.x1, middle)
+        return (region + (-REGION_PADDING, -REGION_PADDING, REGION_PADDING, REGION_PADDING)) & page.rect
+    return body
+
+
+def locate_asset(doc, name: str, page_index: int):
+    """
+    Returns (page, region) for an asset. Page numbers from the model can be one off, so the
+    neighbouring pages are searched for the caption before settling for the whole given page.
+    """
+    for index in (page_index, page_index - 1, page_index + 1):
+        if 0 <= index < len(doc):
+            region = find_asset_region(doc[index], name)
+            if region is not None:
+                return doc[index], region
+    page = doc[page_index]
+    return page, fitz.Rect(0, page.rect.height * HEADER_FRACTION, page.rect.width, page.rect.height * FOOTER_FRACTION)
+
+
+def render_assets(pdf_content: bytes, items: list, dpi: int, quality: int) -> list:
+    """Crops and encodes (name, page index) items as WebP. Runs in a render worker process."""
+    rendered = []
+    doc = fitz.open(stream=pdf_content, filetype="pdf")
+    try:
+        for name, page_index in items:
+            if not 0 <= page_index < len(doc):
+                rendered.append((name, None))
+                continue
+            page, region = locate_asset(doc, name, page_index)
+            pixmap = page.get_pixmap(clip=region, dpi=dpi)
+            rendered.append((name, pixmap.pil_tobytes(format="WEBP", quality=quality)))
+    finally:
+        doc.close()
+    return rendered
+
+
+def get_render_processes() -> int:
+    return int(os.getenv("ASSET_RENDER_PROCESSES", min(4, os.cpu_count() or 1)))
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawned rather than forked: the worker process has threads and open client connections.
+        # Spawning re-imports the parent's __main__ (e.g. worker.py, with the whole pipeline and
+        # the model client), so render processes are slow to start; the pool is kept for good.
+        _pool = ProcessPoolExecutor(max_workers=get_render_processes(), mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def render_document_assets(supabase, pdf_content: bytes, sections: list, sections_data: list) -> dict:
+    """
+    Renders every diagram and table referenced in a document's extracted data to WebP,
+    skipping renders already in storage. Returns the manifest {name: storage path}.
+    """
+    page_offset = sections[0].get("page_offset", 0) if sections else 0
+    items = collect_assets(sections_data, page_offset)
+    if not items:
+        return {}
+
+    dpi = int(os.getenv("ASSET_RENDER_DPI", 150))
+    quality = int(os.getenv("ASSET_WEBP_QUALITY", 80))
+    pdf_hash = hashlib.sha256(pdf_content).hexdigest()
+    keys = {name: asset_key(pdf_hash, name, page_index, dpi) for name, page_index in items}
+    bucket = supabase.storage.from_(ASSET_BUCKET)
+
+    stored = await asyncio.gather(*(asyncio.to_thread(bucket.exists, keys[name]) for name, _ in items))
+    missing = [item for item, exists in zip(items, stored) if not exists]
+
+    if missing:
+        # one task per render process, each opening the PDF once
+        processes = get_render_processes()
+        chunks = [missing[i::processes] for i in range(min(processes, len(missing)))]
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(_get_pool(), render_assets, pdf_content, chunk, dpi, quality) for chunk in chunks
+        ))
+        rendered = [(name, image) for result in results for name, image in result if image]
+        await asyncio.gather(*(
+            asyncio.to_thread(bucket.upload, keys[name], image, {
+                "content-type": "image/webp", "cache-control": str(ASSET_CACHE_SECONDS), "upsert": "true"
+            })
+            for name, image in rendered
+        ))
+        failed = {name for result in results for name, image in result if not image}
+        if failed:
+            print(f"Could not render assets (page out of range): {', '.join(sorted(failed))}")
+        keys = {name: key for name, key in keys.items() if name not in failed}
+        print(f"Rendered {len(rendered)} of {len(items)} assets ({len(items) - len(missing)} already stored)")
+
+    return keys
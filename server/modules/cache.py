@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from config.ai_client import DEFAULT_MODEL
+from modules.questions import PROMPT_VERSION, REFERENCE_SECTIONS, get_extraction_mode
+from modules.utils import REFERENCE_PDF_PATH
+from modules.layout import get_layout_mode
+
+REFERENCE_FILES = [REFERENCE_PDF_PATH, *(config['file'] for config in REFERENCE_SECTIONS.values())]
+
+_reference_version = {"stamp": None, "version": None}
+
+def get_reference_version() -> str:
+    """Hash of the reference PDF and reference JSON files, recomputed only when one of them changes."""
+    stamp = tuple((path, os.path.getmtime(path)) for path in REFERENCE_FILES if os.path.exists(path))
+    if _reference_version["stamp"] != stamp:
+        digest = hashlib.sha256()
+        for path, _ in stamp:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        _reference_version.update(stamp=stamp, version=digest.hexdigest())
+    return _reference_version["version"]
+
+def build_cache_key(pdf_hash: str, model: str = DEFAULT_MODEL) -> str:
+    """Content address for a whole-document extraction, from the PDF's SHA-256 hex digest."""
+    key = f"{pdf_hash}:{PROMPT_VERSION}:{get_extraction_mode()}:{get_layout_mode()}:{get_reference_version()}:{model}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class SQLiteCache:
+    """Result cache in a local SQLite file, evicting least recently used entries above max_bytes."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "create table if not exists extraction_cache ("
+            "key text primary key, value text not null, size integer not null, last_access real not null)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("select value from extraction_cache where key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("update extraction_cache set last_access = ? where key = ?", (time.time(), key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, value: dict) -> None:
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "insert or replace into extraction_cache (key, value, size, last_access) values (?, ?, ?, ?)",
+                (key, payload, len(payload.encode('utf-8')), time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        total = self._conn.execute("select coalesce(sum(size), 0) from extraction_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("select key, size from extraction_cache order by last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("delete from extraction_cache where key = ?", (key,))
+            total -= size
+
+
+class DiskCache:
+    """Result cache as one JSON file per key; file mtimes double as the LRU clock."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return value
+
+    def set(self, key: str, value: dict) -> None:
+        with self._lock:
+            tmp_path = self._path(key) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+class DocumentsTableCache:
+    """
+    Reuses finished rows of the Supabase `documents` table. Needs a `cache_key` and a
+    `sections` column (see README); rows are never evicted here.
+    """
+
+    def __init__(self, supabase):
+        self.supabase = supabase
+
+    def get(self, key: str):
+        response = (
+            self.supabase.table("documents")
+            .select("sections, data, assets")
+            .eq("cache_key", key)
+            .eq("status", "extracted")
+            .limit(1)
+            .execute()
+        )
+        if not response.data:
+            return None
+        row = response.data[0]
+        return {"sections": row["sections"], "data": row["data"], "assets": row.get("assets")}
+
+    def set(self, key: str, value: dict) -> None:
+        # extract_data stores data (and the worker the assets) on the document row itself;
+        # only the key and sections are added
+        self.supabase.table("documents").update(
+            {"cache_key": key, "sections": value["sections"]}
+        ).eq("id", value["document_id"]).execute()
+
+
+def init_cache(supabase=None):
+    """Builds the backend selected by RESULT_CACHE_BACKEND (sqlite, disk, documents or none)."""
+    backend = os.getenv("RESULT_CACHE_BACKEND", "sqlite").lower()
+    max_bytes = int(os.getenv("RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        return SQLiteCache(os.getenv("RESULT_CACHE_PATH") or "cache/extractions.sqlite3", max_bytes)
+    if backend == "disk":
+        return DiskCache(os.getenv("RESULT_CACHE_PATH") or "cache/extractions", max_bytes)
+    if backend == "documents":
+        return DocumentsTableCache(supabase)
+    raise ValueError(f"Unknown RESULT_CACHE_BACKEND: {backend}")
@@ -0,0 +1,163 @@
+import gzip
+import json
+import uuid
+import base64
+import hashlib
+from datetime import datetime
+
+from fastapi import Response, HTTPException
+
+from modules.questions import parse_marks
+
+try:
+    import orjson
+
+    def dumps(value) -> bytes:
+        return orjson.dumps(value)
+except ImportError:
+    def dumps(value) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DOCUMENT_STATUSES = ("in process", "extracted", "edited", "failed")
+# what the documents list shows; the extracted data is only sent for a single document
+LIST_COLUMNS = "id, file_name, file_url, uploaded_date, status"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# documents.data holds the sections in this order
+SECTION_LETTERS = "ABC"
+# smaller bodies are not worth compressing
+COMPRESS_MIN_BYTES = 1024
+
+
+def encode_cursor(row: dict) -> str:
+    """Opaque position after a listed row: its upload date, with the id breaking ties."""
+    return base64.urlsafe_b64encode(f"{row['uploaded_date']}|{row['id']}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """
+    (upload date, id) of a cursor from encode_cursor. Both end up in a PostgREST filter, so
+    anything but a timestamp and a UUID is rejected with a 400.
+    """
+    try:
+        uploaded_date, id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+        datetime.fromisoformat(uploaded_date)
+        id = str(uuid.UUID(id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return uploaded_date, id
+
+
+def list_documents(supabase, limit: int = DEFAULT_PAGE_SIZE, cursor: str = None, statuses: list = None):
+    """
+    One page of documents, newest first, by keyset pagination on (uploaded_date, id).
+    Returns (rows, next cursor or None); an invalid cursor raises HTTPException(400).
+    """
+    query = supabase.table("documents").select(LIST_COLUMNS)
+    if statuses:
+        query = query.in_("status", statuses)
+    if cursor:
+        uploaded_date, id = decode_cursor(cursor)
+        # values are quoted because timestamps contain PostgREST's reserved ':' and '.'
+        query = query.or_(f'uploaded_date.lt."{uploaded_date}",and(uploaded_date.eq."{uploaded_date}",id.lt."{id}")')
+    # one extra row tells whether there is a next page
+    rows = query.order("uploaded_date", desc=True).order("id", desc=True).limit(limit + 1).execute().data
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1])
+    return rows, None
+
+
+def section_index(section: str) -> int:
+    """Position in documents.data of a section given as its letter ("A", "b") or "Section A"."""
+    letter = section.strip().upper().removeprefix("SECTION").strip()
+    if len(letter) != 1 or letter not in SECTION_LETTERS:
+        raise ValueError(f"Unknown section: {section}")
+    return SECTION_LETTERS.index(letter)
+
+
+def entries(items) -> list:
+    """The dict entries of a list in extracted data; edited or model-written data can have anything."""
+    return [item for item in items if isinstance(item, dict)] if isinstance(items, list) else []
+
+
+def question_marks(question: dict):
+    """A question's marks, or the sum of its sub-questions' marks, as an int (None when unknown)."""
+    marks = parse_marks(question.get("marks"))
+    if marks is not None:
+        return marks
+    marks = [parse_marks(sub.get("marks")) for sub in entries(question.get("sub_questions"))]
+    marks = [value for value in marks if value is not None]
+    return sum(marks) if marks else None
+
+
+def build_skeleton(sections_data: list) -> list:
+    """
+    The outline of extracted data: each section's title and marks, and the numbers and
+    marks of its questions, without any content flow.
+    """
+    skeleton = []
+    for letter, section in zip(SECTION_LETTERS, sections_data or []):
+        if not isinstance(section, dict):
+            section = {}
+        main_questions = []
+        for main_question in entries(section.get("main_questions")):
+            questions = [
+                {
+                    "number": question.get("number"),
+                    "marks": question_marks(question),
+                    "sub_questions": [
+                        {"number": sub.get("number"), "marks": parse_marks(sub.get("marks"))}
+                        for sub in entries(question.get("sub_questions"))
+                    ]
+                }
+                for question in entries(main_question.get("questions"))
+            ]
+            marks = [question["marks"] for question in questions if question["marks"] is not None]
+            main_questions.append({
+                "number": main_question.get("number"),
+                "marks": sum(marks) if marks else None,
+                "questions": questions
+            })
+        skeleton.append({
+            "section": letter,
+            "section_title": section.get("section_title"),
+            "section_marks": parse_marks(section.get("section_marks")),
+            "main_questions": main_questions
+        })
+    return skeleton
+
+
+def json_response(request, content) -> Response:
+    """
+    Serializes content once and tags it with an ETag of the body, answering 304 when the
+    client already has it (If-None-Match). Clients must revalidate, so polling stays current.
+    Larger bodies are compressed with brotli (when installed) or gzip, as the client accepts.
+    """
+    body = dumps(content)
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    accepted = {value.split(";")[0].strip() for value in request.headers.get("accept-encoding", "").split(",")}
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        if brotli and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+
+    # each encoding is a different representation, so it gets its own tag
+    etag = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    if encoding == "br":
+        body = brotli.compress(body, quality=5)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=6)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,91 @@
+import json
+import queue
+import atexit
+import asyncio
+import threading
+
+TERMINAL_EVENTS = ("completed", "failed")
+# events that open a new extraction run; streams start from the latest one
+START_EVENTS = ("sections_identified", "resumed")
+HEARTBEAT_SECONDS = 15
+
+# Consumers of every published event. Extraction runs in worker processes, so events
+# are written to the job queue's event log and read back by the API's stream endpoint.
+_sinks = []
+
+def add_sink(sink) -> None:
+    """Registers sink(document_id, message), called for every published event."""
+    _sinks.append(sink)
+
+class BackgroundSink:
+    """
+    Hands events to a blocking sink (e.g. a database insert) on a background thread, in the
+    order they were published, so publishing from the event loop never waits on I/O.
+    Pending events are written before the process exits.
+    """
+
+    def __init__(self, sink):
+        self._sink = sink
+        self._pending = queue.Queue()
+        threading.Thread(target=self._run, name="event-sink", daemon=True).start()
+        atexit.register(self.flush)
+
+    def __call__(self, document_id: str, message: dict) -> None:
+        self._pending.put((document_id, message))
+
+    def _run(self) -> None:
+        while True:
+            document_id, message = self._pending.get()
+            try:
+                self._sink(document_id, message)
+            except Exception as e:
+                print(f"Failed to record {message['event']} for document {document_id}: {str(e)}")
+            finally:
+                self._pending.task_done()
+
+    def flush(self) -> None:
+        """Waits until every event published so far has been handed to the sink."""
+        self._pending.join()
+
+def publish(document_id: str, event: str, data=None) -> None:
+    """Records an extraction progress event. Sink errors are logged, never raised into the pipeline."""
+    message = {"event": event, "data": data}
+    for sink in _sinks:
+        try:
+            sink(document_id, message)
+        except Exception as e:
+            print(f"Failed to publish {event} for document {document_id}: {str(e)}")
+
+def format_sse(message) -> str:
+    """Formats an event for a text/event-stream response (None becomes a heartbeat comment)."""
+    if message is None:
+        return ": keep-alive\n\n"
+    return f"event: {message['event']}\ndata: {json.dumps(message['data'], ensure_ascii=False)}\n\n"
+
+def latest_run_start(recorded: list) -> int:
+    """Given recorded (id, message) pairs, returns the id to poll after so only the latest run is replayed."""
+    start_ids = [event_id for event_id, message in recorded if message["event"] in START_EVENTS]
+    return start_ids[-1] - 1 if start_ids else 0
+
+async def poll(fetch_events, document_id: str, after_id: int = 0, interval: float = 1.0):
+    """
+    Yields events recorded by fetch_events(document_id, after_id), which returns
+    (id, message) pairs, until the job finishes.
+    """
+    last_id = after_id
+    idle = 0.0
+    while True:
+        batch = await asyncio.to_thread(fetch_events, document_id, last_id)
+        for event_id, message in batch:
+            last_id = event_id
+            yield message
+            if message["event"] in TERMINAL_EVENTS:
+                return
+        if batch:
+            idle = 0.0
+        else:
+            idle += interval
+            if idle >= HEARTBEAT_SECONDS:
+                idle = 0.0
+                yield None
+        await asyncio.sleep(interval)
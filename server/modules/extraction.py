@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from modules.questions import (
+    build_extract_section_data_prompt, build_extract_section_schema_prompt, build_continuation_prompt, validate_section,
+    get_extraction_mode
+)
+from modules.json_repair import parse_json, join_continuation
+from modules.utils import get_reference_pdf_part, remap_pages, backoff_delay
+from modules.layout import prepare_sections, get_layout_mode
+from modules import events
+
+from config.logger import log_error
+from config.ai_client import stream_ai_response_async, continue_ai_response_async, convert_pdf_to_part, to_response_schema
+from config.metrics import stage
+from models.schema import Section
+from google.api_core import exceptions as google_exceptions
+from pydantic import ValidationError
+
+# partial output is batched so the event log gets at most one chunk event per section per interval
+CHUNK_EVENT_INTERVAL_SECONDS = 1.0
+
+# errors worth retrying a section for; malformed JSON is included since a new generation usually fixes it
+TRANSIENT_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    json.JSONDecodeError,
+    ValidationError,
+    ConnectionError,
+    asyncio.TimeoutError,
+)
+
+# schema mode: generation is constrained to models.schema.Section
+SECTION_RESPONSE_SCHEMA = to_response_schema(Section)
+
+async def extract_section_data(document_id, section, reference_pdf, section_input, checkpoints=None, fair_key=None):
+    """
+    Extracts one section from its prepared input (see modules.layout.prepare_section),
+    retrying transient errors with jittered backoff, and checkpoints the result.
+    Model calls share rate budget fairly by fair_key (the document unless given, e.g. a batch).
+    """
+    max_attempts = int(os.getenv("SECTION_MAX_ATTEMPTS", 3))
+    for attempt in range(1, max_attempts + 1):
+        try:
+            section_data = await _extract_section_once(document_id, section, reference_pdf, section_input, fair_key or document_id)
+            break
+        except Exception as e:
+            # clients only see a section fail once nothing will retry it
+            if attempt == max_attempts or not isinstance(e, TRANSIENT_ERRORS):
+                events.publish(document_id, "section_failed", {"section": section['name'], "error": str(e)})
+                raise
+            delay = backoff_delay(
+                attempt, float(os.getenv("SECTION_RETRY_BASE_SECONDS", 2)), float(os.getenv("SECTION_RETRY_MAX_SECONDS", 60))
+            )
+            print(f"Retrying {section['name']} in {delay:.1f}s after: {str(e)}")
+            events.publish(document_id, "section_retrying", {"section": section['name'], "attempt": attempt, "error": str(e)})
+            await asyncio.sleep(delay)
+
+    if checkpoints:
+        await asyncio.to_thread(checkpoints.save_checkpoint, document_id, section['name'], section_data)
+    return section_data
+
+async def _extract_section_once(document_id, section, reference_pdf, section_input, fair_key):
+    print(f"Processing section: {section['name']}")
+    events.publish(document_id, "section_started", {"section": section['name']})
+    # the prompt refers to pages by their position in the section input, not printed numbers
+    start_page, end_page = section_input["pages"]
+    page_map = section_input["page_map"]
+    with stage("prompt_build", section=section['name']):
+        if reference_pdf is None:
+            prompt = build_extract_section_schema_prompt(section['name'], start_page, end_page)
+        else:
+            prompt = build_extract_section_data_prompt({**section, "start_page": start_page, "end_page": end_page})
+    section_parts = [convert_pdf_to_part(section_input["pdf"])] if section_input["pdf"] else []
+    if section_input["layout"]:
+        section_parts.append(section_input["layout"])
+    pending = {"text": "", "sent_at": time.monotonic()}
+
+    def on_chunk(text):
+        pending["text"] += text
+        now = time.monotonic()
+        if now - pending["sent_at"] >= CHUNK_EVENT_INTERVAL_SECONDS:
+            events.publish(document_id, "section_chunk", {"section": section['name'], "text": pending["text"]})
+            pending.update(text="", sent_at=now)
+
+    if reference_pdf is None:
+        contents, response_schema = [*section_parts, prompt], SECTION_RESPONSE_SCHEMA
+    else:
+        contents, response_schema = [reference_pdf, *section_parts, prompt], None
+
+    try:
+        response = await stream_ai_response_async(
+            contents, on_chunk, response_schema=response_schema, fair_key=fair_key, section=section['name']
+        )
+        # the tail of the stream arrived within the last interval
+        if pending["text"]:
+            events.publish(document_id, "section_chunk", {"section": section['name'], "text": pending["text"]})
+            pending["text"] = ""
+        response_text = response.text
+        with stage("json_parse", section=section['name']):
+            parsed, repaired, truncated = parse_json(response_text)
+
+        # cut-off output is continued from where it stopped instead of regenerating the section
+        continuations = 0
+        while truncated and continuations < int(os.getenv("SECTION_MAX_CONTINUATIONS", 2)):
+            continuations += 1
+            print(f"Continuing truncated output of {section['name']}")
+            events.publish(document_id, "section_continuing", {"section": section['name'], "continuation": continuations})
+            continuation = await continue_ai_response_async(
+                contents, response_text, build_continuation_prompt(response_text),
+                fair_key=fair_key, section=section['name']
+            )
+            response_text = join_continuation(response_text, continuation.text)
+            with stage("json_parse", section=section['name']):
+                parsed, repaired, truncated = parse_json(response_text)
+
+        with stage("validation", section=section['name']):
+            if reference_pdf is None:
+                parsed = Section.model_validate(parsed).model_dump(mode="json", exclude_none=True)
+            problems = validate_section(parsed, section['name'])
+        if truncated:
+            problems.insert(0, "response was cut off and closed by repair")
+        elif repaired:
+            problems.insert(0, "response JSON was repaired")
+        section_data = remap_pages(parsed, page_map)
+        logging.debug(f"{section['name']} response: {response_text}")
+        events.publish(document_id, "section_done", {"section": section['name'], "data": section_data, "problems": problems})
+        return section_data
+    except Exception as e:
+        print(f"Error in extract_section_data ({section['name']}): {str(e)}")
+        log_error(f"{section['name']}: {str(e)}", response_text if 'response_text' in locals() else None)
+        raise
+
+async def extract_sections(pdf_content: bytes, sections, document_id: str, checkpoints=None, fair_key=None) -> list:
+    """
+    Extracts every section of a PDF and returns the sections' data in order, without storing
+    anything but checkpoints. Sections already saved in `checkpoints` (a job queue) are reused
+    instead of re-extracted. Raises if any section fails.
+    """
+    completed = await asyncio.to_thread(checkpoints.get_checkpoints, document_id) if checkpoints else {}
+    missing_sections = [section for section in sections if section['name'] not in completed]
+    for section in sections:
+        if section['name'] in completed:
+            print(f"Reusing checkpoint for {section['name']}")
+            events.publish(document_id, "section_done", {"section": section['name'], "data": completed[section['name']]})
+
+    if missing_sections:
+        # schema mode needs no reference PDF; the response schema carries the structure
+        reference_pdf = None
+        if get_extraction_mode() == "reference":
+            with stage("reference_pdf"):
+                reference_pdf = await asyncio.to_thread(get_reference_pdf_part)
+        # each section prompt only carries that section's pages (plus optional context pages)
+        context_pages = int(os.getenv("SECTION_CONTEXT_PAGES", 0))
+        layout_mode = get_layout_mode()
+        with stage("page_slicing", sections=len(missing_sections), layout=layout_mode):
+            section_inputs = await asyncio.to_thread(
+                prepare_sections, pdf_content, missing_sections, context_pages, layout_mode
+            )
+
+        print("Extracting data from sections...")
+        # sections run concurrently (bounded by the limits in config.ai_client);
+        # gather keeps results in section order
+        results = await asyncio.gather(
+            *(
+                extract_section_data(document_id, section, reference_pdf, section_input, checkpoints, fair_key)
+                for section, section_input in zip(missing_sections, section_inputs)
+            ),
+            return_exceptions=True
+        )
+
+        failed_sections = [
+            f"{section['name']}: {str(result)}"
+            for section, result in zip(missing_sections, results)
+            if isinstance(result, Exception)
+        ]
+        if failed_sections:
+            raise ValueError(f"Error extracting section data: {'; '.join(failed_sections)}")
+        completed.update((section['name'], result) for section, result in zip(missing_sections, results))
+
+    return [completed[section['name']] for section in sections]
+
+def _write_output(sections_data: list) -> None:
+    with open("outputs/temporary_output_data.json", "w", encoding="utf-8") as json_file:
+        json.dump(sections_data, json_file, ensure_ascii=False, indent=4)
+
+async def extract_data(supabase, pdf_content: bytes, sections, document_id: str, cache_key: str = None, result_cache=None, checkpoints=None, fair_key=None):
+    """
+    Extracts every section of a document (see extract_sections) and stores the result on its
+    `documents` row. Raises on failure; marking the document as failed is left to the caller
+    (see modules.jobs).
+    """
+    sections_data = await extract_sections(pdf_content, sections, document_id, checkpoints, fair_key)
+    with stage("db_write", document_id=document_id):
+        await asyncio.to_thread(
+            supabase.table("documents").update({"data": sections_data, "status": "extracted"}).eq("id", document_id).execute
+        )
+    events.publish(document_id, "completed", {"status": "extracted", "data": sections_data})
+
+    # the document is extracted at this point: the cache entry and the debug dump are best
+    # effort, so a failure in either does not re-run (or fail) a finished extraction
+    if result_cache and cache_key:
+        try:
+            await asyncio.to_thread(result_cache.set, cache_key, {"sections": sections, "data": sections_data, "document_id": document_id})
+        except Exception as e:
+            print(f"Caching the result of document {document_id} failed: {str(e)}")
+    try:
+        await asyncio.to_thread(_write_output, sections_data)
+    except Exception as e:
+        print(f"Writing outputs/temporary_output_data.json failed: {str(e)}")
+    # cleared last, so a retry after any earlier error resumes from the finished sections
+    if checkpoints:
+        await asyncio.to_thread(checkpoints.clear_checkpoints, document_id)
+    return {"status": "Success", "data": sections_data}
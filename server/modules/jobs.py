@@ -0,0 +1,444 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+from datetime import datetime, timezone
+
+from modules import events
+from modules.extraction import extract_data
+from modules.assets import render_document_assets
+from modules.question_store import flatten_questions
+from modules.utils import backoff_delay
+from config.metrics import stage, start_trace, QUEUE_WAIT_SECONDS
+
+# Job lifecycle: queued -> running -> succeeded, or back to queued with a backoff delay
+# until max_attempts is reached, then failed. A running job whose worker stops sending
+# heartbeats becomes claimable again once its visibility timeout (locked_until) passes.
+# documents.status mirrors this: 'in process' while queued/running, then 'extracted' or 'failed'.
+
+# how often each worker deletes expired progress events
+EVENT_PRUNE_INTERVAL_SECONDS = 600
+
+def retry_delay(attempts: int) -> float:
+    return backoff_delay(
+        attempts, float(os.getenv("JOB_RETRY_BASE_SECONDS", 10)), float(os.getenv("JOB_RETRY_MAX_SECONDS", 600))
+    )
+
+
+def _timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+
+class SQLiteJobQueue:
+    """Persistent job queue in a local SQLite file, shared by the API and worker processes on one host."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.executescript("""
+            create table if not exists jobs (
+                id text primary key,
+                document_id text not null,
+                payload text not null,
+                status text not null default 'queued',
+                attempts integer not null default 0,
+                max_attempts integer not null,
+                available_at real not null,
+                locked_until real,
+                worker_id text,
+                last_error text,
+                created_at real not null,
+                updated_at real not null
+            );
+            create index if not exists jobs_claim_idx on jobs (status, available_at);
+            create table if not exists job_events (
+                id integer primary key autoincrement,
+                document_id text not null,
+                event text not null,
+                data text,
+                created_at real not null default 0
+            );
+            create index if not exists job_events_document_idx on job_events (document_id, id);
+            create table if not exists section_checkpoints (
+                document_id text not null,
+                section text not null,
+                data text not null,
+                primary key (document_id, section)
+            );
+        """)
+        # files created before events had a timestamp; their events count as old
+        if "created_at" not in {row[1] for row in self._conn.execute("pragma table_info(job_events)")}:
+            self._conn.execute("alter table job_events add column created_at real not null default 0")
+        self._conn.execute("create index if not exists job_events_created_idx on job_events (created_at)")
+
+    def _execute(self, query: str, params=()):
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def enqueue(self, document_id: str, payload: dict, max_attempts: int = None) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        max_attempts = max_attempts or int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+        self._execute(
+            "insert into jobs (id, document_id, payload, max_attempts, available_at, created_at, updated_at) "
+            "values (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, document_id, json.dumps(payload), max_attempts, now, now, now)
+        )
+        return job_id
+
+    def claim(self, worker_id: str, visibility_timeout: float):
+        """Atomically takes the oldest available job (or one whose lock expired), or returns None."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("begin immediate")
+            try:
+                row = self._conn.execute(
+                    "select id, document_id, payload, attempts, max_attempts from jobs "
+                    "where (status = 'queued' and available_at <= ?) or (status = 'running' and locked_until < ?) "
+                    "order by available_at limit 1",
+                    (now, now)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "update jobs set status = 'running', attempts = attempts + 1, locked_until = ?, "
+                        "worker_id = ?, updated_at = ? where id = ?",
+                        (now + visibility_timeout, worker_id, now, row[0])
+                    )
+                self._conn.execute("commit")
+            except Exception:
+                self._conn.execute("rollback")
+                raise
+        if row is None:
+            return None
+        return {
+            "id": row[0], "document_id": row[1], "payload": json.loads(row[2]),
+            "attempts": row[3] + 1, "max_attempts": row[4]
+        }
+
+    def heartbeat(self, job_id: str, visibility_timeout: float) -> None:
+        now = time.time()
+        self._execute(
+            "update jobs set locked_until = ?, updated_at = ? where id = ? and status = 'running'",
+            (now + visibility_timeout, now, job_id)
+        )
+
+    def complete(self, job_id: str) -> None:
+        self._execute(
+            "update jobs set status = 'succeeded', locked_until = null, updated_at = ? where id = ?",
+            (time.time(), job_id)
+        )
+
+    def fail(self, job: dict, error: str) -> bool:
+        """Records a failed attempt. Returns True if the job was re-queued for another attempt."""
+        now = time.time()
+        if job["attempts"] < job["max_attempts"]:
+            self._execute(
+                "update jobs set status = 'queued', available_at = ?, locked_until = null, last_error = ?, "
+                "updated_at = ? where id = ?",
+                (now + retry_delay(job["attempts"]), error, now, job["id"])
+            )
+            return True
+        self._execute(
+            "update jobs set status = 'failed', locked_until = null, last_error = ?, updated_at = ? where id = ?",
+            (error, now, job["id"])
+        )
+        return False
+
+    def get_latest_job(self, document_id: str):
+        rows = self._execute(
+            "select id, status, payload from jobs where document_id = ? order by created_at desc limit 1",
+            (document_id,)
+        )
+        if not rows:
+            return None
+        return {"id": rows[0][0], "status": rows[0][1], "payload": json.loads(rows[0][2])}
+
+    def save_checkpoint(self, document_id: str, section: str, data) -> None:
+        self._execute(
+            "insert or replace into section_checkpoints (document_id, section, data) values (?, ?, ?)",
+            (document_id, section, json.dumps(data, ensure_ascii=False))
+        )
+
+    def get_checkpoints(self, document_id: str) -> dict:
+        rows = self._execute("select section, data from section_checkpoints where document_id = ?", (document_id,))
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def clear_checkpoints(self, document_id: str) -> None:
+        self._execute("delete from section_checkpoints where document_id = ?", (document_id,))
+
+    def add_event(self, document_id: str, message: dict) -> None:
+        self._execute(
+            "insert into job_events (document_id, event, data, created_at) values (?, ?, ?, ?)",
+            (document_id, message["event"], json.dumps(message["data"], ensure_ascii=False), time.time())
+        )
+
+    def get_events(self, document_id: str, after_id: int = 0) -> list:
+        rows = self._execute(
+            "select id, event, data from job_events where document_id = ? and id > ? order by id",
+            (document_id, after_id)
+        )
+        return [(row[0], {"event": row[1], "data": json.loads(row[2])}) for row in rows]
+
+    def prune_events(self, retention: float, ttl: float) -> int:
+        """
+        Deletes a run's events `retention` seconds after its terminal event (later runs of the
+        document are kept), and any event older than `ttl`. Returns the number deleted.
+        """
+        now = time.time()
+        placeholders = ", ".join("?" for _ in events.TERMINAL_EVENTS)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"""
+                delete from job_events where created_at < ? or id <= (
+                    select max(id) from job_events as terminal
+                    where terminal.document_id = job_events.document_id
+                    and terminal.event in ({placeholders}) and terminal.created_at < ?
+                )
+                """,
+                (now - ttl, *events.TERMINAL_EVENTS, now - retention)
+            )
+            return cursor.rowcount
+
+
+class SupabaseJobQueue:
+    """
+    Job queue on the `extraction_jobs` / `extraction_job_events` tables. Claiming goes
+    through the `claim_extraction_job` function (see README) so it can use SKIP LOCKED.
+    """
+
+    def __init__(self, supabase):
+        self.supabase = supabase
+
+    def enqueue(self, document_id: str, payload: dict, max_attempts: int = None) -> str:
+        response = self.supabase.table("extraction_jobs").insert({
+            "document_id": document_id,
+            "payload": payload,
+            "max_attempts": max_attempts or int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+        }).execute()
+        return response.data[0]["id"]
+
+    def claim(self, worker_id: str, visibility_timeout: float):
+        response = self.supabase.rpc(
+            "claim_extraction_job", {"p_worker_id": worker_id, "p_visibility_timeout": visibility_timeout}
+        ).execute()
+        if not response.data:
+            return None
+        row = response.data[0]
+        return {
+            "id": row["id"], "document_id": row["document_id"], "payload": row["payload"],
+            "attempts": row["attempts"], "max_attempts": row["max_attempts"]
+        }
+
+    def heartbeat(self, job_id: str, visibility_timeout: float) -> None:
+        self.supabase.rpc(
+            "extend_extraction_job", {"p_job_id": job_id, "p_visibility_timeout": visibility_timeout}
+        ).execute()
+
+    def complete(self, job_id: str) -> None:
+        self.supabase.table("extraction_jobs").update({"status": "succeeded", "locked_until": None}).eq("id", job_id).execute()
+
+    def fail(self, job: dict, error: str) -> bool:
+        if job["attempts"] < job["max_attempts"]:
+            available_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + retry_delay(job["attempts"])))
+            self.supabase.table("extraction_jobs").update({
+                "status": "queued", "available_at": available_at, "locked_until": None, "last_error": error
+            }).eq("id", job["id"]).execute()
+            return True
+        self.supabase.table("extraction_jobs").update(
+            {"status": "failed", "locked_until": None, "last_error": error}
+        ).eq("id", job["id"]).execute()
+        return False
+
+    def get_latest_job(self, document_id: str):
+        response = (
+            self.supabase.table("extraction_jobs")
+            .select("id, status, payload")
+            .eq("document_id", document_id)
+            .order("created_at", desc=True)
+            .limit(1)
+            .execute()
+        )
+        return response.data[0] if response.data else None
+
+    def save_checkpoint(self, document_id: str, section: str, data) -> None:
+        self.supabase.table("extraction_checkpoints").upsert(
+            {"document_id": document_id, "section": section, "data": data}
+        ).execute()
+
+    def get_checkpoints(self, document_id: str) -> dict:
+        response = self.supabase.table("extraction_checkpoints").select("section, data").eq("document_id", document_id).execute()
+        return {row["section"]: row["data"] for row in response.data}
+
+    def clear_checkpoints(self, document_id: str) -> None:
+        self.supabase.table("extraction_checkpoints").delete().eq("document_id", document_id).execute()
+
+    def add_event(self, document_id: str, message: dict) -> None:
+        self.supabase.table("extraction_job_events").insert(
+            {"document_id": document_id, "event": message["event"], "data": message["data"]}
+        ).execute()
+
+    def get_events(self, document_id: str, after_id: int = 0) -> list:
+        response = (
+            self.supabase.table("extraction_job_events")
+            .select("id, event, data")
+            .eq("document_id", document_id)
+            .gt("id", after_id)
+            .order("id")
+            .execute()
+        )
+        return [(row["id"], {"event": row["event"], "data": row["data"]}) for row in response.data]
+
+    def prune_events(self, retention: float, ttl: float) -> int:
+        """Same as SQLiteJobQueue.prune_events; created_at is set by the database."""
+        now = time.time()
+        response = (
+            self.supabase.table("extraction_job_events")
+            .select("id, document_id")
+            .in_("event", list(events.TERMINAL_EVENTS))
+            .lt("created_at", _timestamp(now - retention))
+            .execute()
+        )
+        last_terminal = {}
+        for row in response.data:
+            last_terminal[row["document_id"]] = max(row["id"], last_terminal.get(row["document_id"], 0))
+        deleted = 0
+        for document_id, event_id in last_terminal.items():
+            deleted += len(
+                self.supabase.table("extraction_job_events").delete()
+                .eq("document_id", document_id).lte("id", event_id).execute().data
+            )
+        deleted += len(
+            self.supabase.table("extraction_job_events").delete().lt("created_at", _timestamp(now - ttl)).execute().data
+        )
+        return deleted
+
+
+def init_job_queue(supabase=None):
+    """Builds the backend selected by JOB_QUEUE_BACKEND (sqlite or supabase)."""
+    backend = os.getenv("JOB_QUEUE_BACKEND", "sqlite").lower()
+    if backend == "sqlite":
+        return SQLiteJobQueue(os.getenv("JOB_QUEUE_PATH") or "cache/jobs.sqlite3")
+    if backend == "supabase":
+        return SupabaseJobQueue(supabase)
+    raise ValueError(f"Unknown JOB_QUEUE_BACKEND: {backend}")
+
+
+async def process_job(job: dict, queue, supabase, result_cache=None, visibility_timeout: float = 300, question_store=None) -> None:
+    document_id = job["document_id"]
+    payload = job["payload"]
+    # continue the trace started by the upload request
+    start_trace(payload.get("traceparent"))
+    # later attempts would count earlier runs and retry backoff as queue wait
+    if payload.get("enqueued_at") and job["attempts"] == 1:
+        QUEUE_WAIT_SECONDS.observe(time.time() - payload["enqueued_at"])
+    print(f"Running job {job['id']} for document {document_id} (attempt {job['attempts']}/{job['max_attempts']})")
+
+    async def keep_alive():
+        while True:
+            await asyncio.sleep(visibility_timeout / 3)
+            # a missed heartbeat is retried on the next tick; the lock only lapses if they keep failing
+            try:
+                await asyncio.to_thread(queue.heartbeat, job["id"], visibility_timeout)
+            except Exception as e:
+                print(f"Heartbeat for job {job['id']} failed: {str(e)}")
+
+    heartbeat = asyncio.create_task(keep_alive())
+    try:
+        with stage("extraction", document_id=document_id, attempt=job["attempts"]):
+            with stage("storage_download"):
+                pdf_content = await asyncio.to_thread(supabase.storage.from_("files").download, payload["storage_path"])
+            result = await extract_data(
+                supabase, pdf_content, payload["sections"], document_id,
+                cache_key=payload.get("cache_key"), result_cache=result_cache, checkpoints=queue,
+                fair_key=payload.get("fair_key")
+            )
+        await asyncio.to_thread(queue.complete, job["id"])
+        await index_questions(question_store, document_id, result["data"])
+        await render_assets(supabase, pdf_content, payload, document_id, result["data"], result_cache)
+    except Exception as e:
+        print(f"Job {job['id']} failed: {str(e)}")
+        try:
+            retrying = await asyncio.to_thread(queue.fail, job, str(e))
+        except Exception as fail_error:
+            # the job stays locked and is claimed again once its visibility timeout passes
+            print(f"Recording the failure of job {job['id']} failed: {str(fail_error)}")
+            return
+        if retrying:
+            events.publish(document_id, "retrying", {"attempt": job["attempts"], "error": str(e)})
+        else:
+            await asyncio.to_thread(supabase.table("documents").update({"status": "failed"}).eq("id", document_id).execute)
+            events.publish(document_id, "failed", {"status": "failed", "error": str(e)})
+    finally:
+        heartbeat.cancel()
+
+async def index_questions(question_store, document_id: str, sections_data: list) -> None:
+    """Replaces the document's rows in the question store. Best effort, like render_assets."""
+    if question_store is None:
+        return
+    try:
+        with stage("question_index", document_id=document_id):
+            await asyncio.to_thread(question_store.replace_document, document_id, flatten_questions(document_id, sections_data))
+    except Exception as e:
+        print(f"Indexing questions of document {document_id} failed: {str(e)}")
+
+async def render_assets(supabase, pdf_content: bytes, payload: dict, document_id: str, sections_data: list, result_cache=None) -> None:
+    """
+    Pre-renders the document's diagrams and tables once extraction has finished and records
+    the manifest on its row (and cache entry). Best effort: the extraction stands without it.
+    """
+    try:
+        with stage("asset_render", document_id=document_id):
+            assets = await render_document_assets(supabase, pdf_content, payload["sections"], sections_data)
+        if not assets:
+            return
+        await asyncio.to_thread(supabase.table("documents").update({"assets": assets}).eq("id", document_id).execute)
+        if result_cache and payload.get("cache_key"):
+            await asyncio.to_thread(result_cache.set, payload["cache_key"], {
+                "sections": payload["sections"], "data": sections_data, "document_id": document_id, "assets": assets
+            })
+    except Exception as e:
+        print(f"Rendering assets for document {document_id} failed: {str(e)}")
+
+async def prune_events(queue, interval: float = EVENT_PRUNE_INTERVAL_SECONDS) -> None:
+    """Periodically drops progress events nobody will stream any more."""
+    retention = float(os.getenv("JOB_EVENTS_RETENTION_SECONDS", 3600))
+    ttl = float(os.getenv("JOB_EVENTS_TTL_SECONDS", 7 * 24 * 3600))
+    while True:
+        try:
+            deleted = await asyncio.to_thread(queue.prune_events, retention, ttl)
+            if deleted:
+                print(f"Pruned {deleted} job events")
+        except Exception as e:
+            print(f"Pruning job events failed: {str(e)}")
+        await asyncio.sleep(interval)
+
+async def run_worker(queue, supabase, result_cache=None, concurrency: int = 2, poll_interval: float = 2.0, question_store=None):
+    """Claims and runs up to `concurrency` jobs at a time until cancelled."""
+    worker_id = f"{os.uname().nodename}:{os.getpid()}"
+    visibility_timeout = float(os.getenv("JOB_VISIBILITY_TIMEOUT_SECONDS", 300))
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+
+    print(f"Worker {worker_id} started with concurrency {concurrency}")
+    pruning = asyncio.create_task(prune_events(queue))
+    while True:
+        await slots.acquire()
+        try:
+            job = await asyncio.to_thread(queue.claim, worker_id, visibility_timeout)
+        except Exception as e:
+            print(f"Claiming a job failed: {str(e)}")
+            job = None
+        if job is None:
+            slots.release()
+            await asyncio.sleep(poll_interval)
+            continue
+
+        task = asyncio.create_task(process_job(job, queue, supabase, result_cache, visibility_timeout, question_store))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        task.add_done_callback(lambda _: slots.release())
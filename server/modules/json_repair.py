@@ -0,0 +1,232 @@
+import re
+import json
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+# characters that end a run of plain string content
+_STRING_SPECIAL = re.compile(r'["\\\x00-\x1f]')
+_WORD = re.compile(r'[A-Za-z0-9_.+\-]+')
+_NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?$')
+_KEY = re.compile(r'"(?:[^"\\\n]|\\.)*"\s*:')
+_FENCE = re.compile(r"^\s*```[a-z]*[ \t]*\n?|\n?```\s*$")
+_LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+# what may follow the comma after a real closing quote: a value, a key, or a (trailing comma) close
+_AFTER_COMMA = re.compile(r'["{\[\]}\-0-9]|true|false|null')
+
+
+def parse_json(text: str):
+    """
+    Parses model output, repairing it if needed. Returns (data, repaired, truncated);
+    raises json.JSONDecodeError when nothing usable can be recovered.
+    """
+    try:
+        return loads(text), False, False
+    except json.JSONDecodeError as e:
+        error = e
+    repaired, truncated = repair_json(text)
+    try:
+        return loads(repaired), True, truncated
+    except json.JSONDecodeError:
+        raise error
+
+
+def join_continuation(partial_text: str, continuation: str) -> str:
+    """Appends a continuation to cut-off output, or replaces it when the model started over."""
+    continuation = _FENCE.sub("", continuation)
+    if continuation.lstrip().startswith(partial_text.lstrip()[:40]):
+        return continuation
+    return partial_text + continuation
+
+
+def repair_json(text: str):
+    """
+    Rewrites almost-JSON in one linear pass: text around the value (markdown fences,
+    comments from the model) is dropped, trailing commas removed, missing commas,
+    colons and object closes added, unescaped quotes and raw control characters inside strings escaped,
+    and anything left open at the end (string, array, object, dangling key) closed.
+    Returns the repaired text and whether the input was cut off.
+    """
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return text, False
+
+    out = []
+    stack = []
+    # last significant token: "open", "comma", "key", "colon" or "value"
+    last = None
+    key_start = 0
+    length = len(text)
+    i = start
+
+    def before_value():
+        nonlocal last
+        if last == "value":
+            out.append(",")
+            last = "comma"
+        elif last == "key":
+            out.append(":")
+            last = "colon"
+
+    def drop_dangling():
+        # removes what cannot stand before a closing bracket: a comma, or a key without a value
+        nonlocal last
+        if stack and stack[-1] == "{" and last in ("key", "colon"):
+            del out[key_start:]
+            last = "comma" if out and out[-1] == "," else "open"
+        if last == "comma":
+            out.pop()
+            last = "value"
+
+    while i < length:
+        c = text[i]
+        if c in " \t\r\n":
+            i += 1
+        elif c == '"':
+            is_key = bool(stack) and stack[-1] == "{" and last in ("open", "comma", "value")
+            if is_key:
+                if last == "value":
+                    out.append(",")
+                key_start = len(out)
+            else:
+                before_value()
+            i, closed = _read_string(text, i + 1, is_key, out)
+            if not closed:
+                last = "key" if is_key else "value"
+                break
+            last = "key" if is_key else "value"
+        elif c in "{[":
+            # a value where a key belongs: the object before it was never closed
+            while stack[-1:] == ["{"] and last in ("open", "comma", "value") and "[" in stack:
+                drop_dangling()
+                stack.pop()
+                out.append("}")
+                last = "value"
+            before_value()
+            out.append(c)
+            stack.append(c)
+            last = "open"
+            i += 1
+        elif c in "}]":
+            opener = "{" if c == "}" else "["
+            i += 1
+            if opener not in stack:
+                continue
+            while True:
+                drop_dangling()
+                top = stack.pop()
+                out.append("}" if top == "{" else "]")
+                last = "value"
+                if top == opener:
+                    break
+            if not stack:
+                return "".join(out), False
+        elif c == ",":
+            i += 1
+            if last in ("open", "comma") or not stack:
+                continue
+            if last in ("key", "colon"):
+                before_value()
+                out.append("null")
+            out.append(",")
+            last = "comma"
+        elif c == ":":
+            i += 1
+            if last == "key":
+                out.append(":")
+                last = "colon"
+        else:
+            match = _WORD.match(text, i)
+            if not match:
+                # stray punctuation such as a markdown fence
+                i += 1
+                continue
+            word = match.group()
+            i = match.end()
+            if word in _LITERALS or _NUMBER.match(word):
+                if i == length:
+                    # a literal or number cut off at the end is not trustworthy
+                    break
+                before_value()
+                out.append(_LITERALS.get(word, word))
+                last = "value"
+            elif stack and stack[-1] == "{" and last in ("open", "comma"):
+                # unquoted key
+                key_start = len(out)
+                out.append(json.dumps(word))
+                last = "key"
+
+    while stack:
+        drop_dangling()
+        out.append("}" if stack.pop() == "{" else "]")
+        last = "value"
+    return "".join(out), True
+
+
+def _read_string(text: str, i: int, is_key: bool, out: list):
+    """
+    Copies a string starting after its opening quote into out, escaping what JSON
+    does not allow. Returns (index after the string, whether it was closed).
+    """
+    length = len(text)
+    out.append('"')
+    while True:
+        match = _STRING_SPECIAL.search(text, i)
+        if not match:
+            out.append(text[i:])
+            out.append('"')
+            return length, False
+        j = match.start()
+        out.append(text[i:j])
+        c = text[j]
+        if c == '"':
+            if _closes_string(text, j + 1, is_key):
+                out.append('"')
+                return j + 1, True
+            out.append('\\"')
+            i = j + 1
+        elif c == "\\":
+            if j + 1 >= length:
+                out.append('"')
+                return length, False
+            escaped = text[j + 1]
+            if escaped == "u" and re.match(r"[0-9a-fA-F]{4}", text[j + 2:j + 6]):
+                out.append(text[j:j + 6])
+                i = j + 6
+            elif escaped in '"\\/bfnrt':
+                out.append(text[j:j + 2])
+                i = j + 2
+            else:
+                # lone backslash, e.g. LaTeX from the paper
+                out.append("\\\\")
+                i = j + 1
+        else:
+            out.append(_CONTROL_ESCAPES.get(c, f"\\u{ord(c):04x}"))
+            i = j + 1
+
+
+def _closes_string(text: str, i: int, is_key: bool) -> bool:
+    """Decides whether a quote ends its string by looking at the next significant character."""
+    length = len(text)
+    j = i
+    while j < length and text[j] in " \t\r\n":
+        j += 1
+    if j == length:
+        return True
+    following = text[j]
+    if is_key:
+        return following in ':",}'
+    if following in "}]:":
+        return True
+    if following == '"':
+        # a value followed by the next key: a missing comma
+        return "\n" in text[i:j] or _KEY.match(text, j) is not None
+    if following == ",":
+        k = j + 1
+        while k < length and text[k] in " \t\r\n":
+            k += 1
+        return k == length or _AFTER_COMMA.match(text, k) is not None
+    return False
@@ -0,0 +1,139 @@
+import os
+import re
+
+import fitz
+
+from modules.utils import section_page_indices, slice_pdf_pages
+
+# "off": sections are sent as PDF slices only;
+# "hints": the slices go with question anchors, captions and marks read from the text layer;
+# "text": like "hints", but pages without images or drawings are sent as text instead of PDF
+LAYOUT_MODES = ("off", "hints", "text")
+
+# running headers and footers (printed page number, paper code, SULIT) sit in these margins
+HEADER_FRACTION = 0.08
+FOOTER_FRACTION = 0.93
+# main question numbers start at the left text margin
+ANCHOR_INDENT = 20
+
+MAIN_NUMBER = re.compile(r"(\d{1,2})(?=\s|$)")
+PART = re.compile(r"\(([a-h])\)\s*")
+SUBPART = re.compile(r"\((i{1,3}|iv|v|vi{1,3}|ix|x)\)\s*")
+CAPTION = re.compile(r"(Rajah|Diagram|Jadual|Table)\s+(\d+(?:\.\d+)*(?:\s?\([a-z]\))?)$")
+MARKS = re.compile(r"\[\s*(\d+)\s*(?:markah|marks?)\s*\]", re.IGNORECASE)
+ANSWER_LINE = re.compile(r"[.…_\s]{10,}$")
+
+
+def get_layout_mode() -> str:
+    mode = os.getenv("LAYOUT_MODE", "off")
+    if mode not in LAYOUT_MODES:
+        raise ValueError(f"Unknown layout mode: {mode}")
+    return mode
+
+
+def read_page_layout(page) -> dict:
+    """
+    Reads one page's text layer: anchors (question numbers, diagram/table captions in either language,
+    mark annotations) with their distance from the top, the body text in reading order,
+    and whether the page has anything visual that only the rendered PDF shows.
+    """
+    top = page.rect.height * HEADER_FRACTION
+    bottom = page.rect.height * FOOTER_FRACTION
+    lines = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"]:
+        for line in block.get("lines", []):
+            text = "".join(span["text"] for span in line["spans"]).strip()
+            x0, y0, _, y1 = line["bbox"]
+            if text and y1 > top and y0 < bottom:
+                lines.append((round(y0), round(x0), text))
+    lines.sort()
+
+    left = min((x0 for _, x0, _ in lines), default=0)
+    anchors = []
+    body = []
+    answer_lines = 0
+    for y, x0, text in lines:
+        if ANSWER_LINE.match(text):
+            answer_lines += 1
+            continue
+        if answer_lines:
+            body.append(f"[answer lines: {answer_lines}]")
+            answer_lines = 0
+        body.append(text)
+
+        rest = text
+        match = MAIN_NUMBER.match(rest)
+        if match and x0 <= left + ANCHOR_INDENT:
+            anchors.append(f"Q{match.group(1)} y{y}")
+            rest = rest[match.end():].lstrip()
+        for pattern in (PART, SUBPART):
+            match = pattern.match(rest)
+            if match:
+                anchors.append(f"({match.group(1)}) y{y}")
+                rest = rest[match.end():]
+        match = CAPTION.match(text)
+        if match:
+            anchors.append(f"{match.group(1)} {match.group(2)} y{y}")
+        for match in MARKS.finditer(text):
+            anchors.append(f"[{match.group(1)} markah] y{y}")
+    if answer_lines:
+        body.append(f"[answer lines: {answer_lines}]")
+
+    return {
+        "anchors": anchors,
+        "text": "\n".join(body),
+        "visual": bool(page.get_images() or page.get_cdrawings()),
+    }
+
+
+def prepare_section(doc, section: dict, context_pages: int = 0, mode: str = "off") -> dict:
+    """
+    Builds what the model gets for one section of an open fitz document:
+      pdf       - PDF slice bytes (None when every page went as text)
+      page_map  - page position in the slice -> printed page number
+      layout    - anchors block and text-only pages, or None
+      pages     - (first, last) section page of the section itself, excluding context pages;
+                  section pages are numbered from 1 and equal slice positions unless pages went as text
+    """
+    offset = section.get("page_offset", 0)
+    indices = section_page_indices(doc, section["start_page"], section["end_page"], offset, context_pages)
+    printed = [index + offset + 1 for index in indices]
+    pages = (
+        next((number for number, page in enumerate(printed, 1) if page >= section["start_page"]), 1),
+        max((number for number, page in enumerate(printed, 1) if page <= section["end_page"]), default=len(printed)),
+    )
+
+    if mode == "off":
+        pdf, page_map = slice_pdf_pages(doc, indices, offset)
+        return {"pdf": pdf, "page_map": page_map, "layout": None, "pages": pages}
+
+    layouts = [read_page_layout(doc[index]) for index in indices]
+    pdf_indices = indices if mode == "hints" else [index for index, layout in zip(indices, layouts) if layout["visual"]]
+    pdf, page_map = slice_pdf_pages(doc, pdf_indices, offset) if pdf_indices else (None, {})
+    positions = {index: position for position, index in enumerate(pdf_indices, 1)}
+
+    anchor_lines = []
+    text_pages = []
+    for number, (index, layout) in enumerate(zip(indices, layouts), 1):
+        where = f"PDF page {positions[index]}" if index in positions else "text below"
+        anchor_lines.append(f"p{number} [{where}]: {' | '.join(layout['anchors'])}")
+        if index not in positions:
+            text_pages.append(f"--- p{number} ---\n{layout['text']}")
+
+    layout = (
+        "SECTION PAGES (p1 is the first page of this section input) with anchors read from the PDF "
+        "text layer; y is the distance from the top of the page. Use them to place questions, "
+        "diagrams, tables and marks:\n" + "\n".join(anchor_lines)
+    )
+    if text_pages:
+        layout += "\n\nPAGES WITHOUT DIAGRAMS OR TABLES, GIVEN AS TEXT INSTEAD OF PDF:\n" + "\n".join(text_pages)
+    return {"pdf": pdf, "page_map": page_map, "layout": layout, "pages": pages}
+
+
+def prepare_sections(pdf_content: bytes, sections: list, context_pages: int = 0, mode: str = "off") -> list:
+    """Opens the PDF once and prepares every section's model input (see prepare_section)."""
+    doc = fitz.open(stream=pdf_content, filetype="pdf")
+    try:
+        return [prepare_section(doc, section, context_pages, mode) for section in sections]
+    finally:
+        doc.close()
@@ -0,0 +1,245 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+
+from modules.questions import parse_marks
+from modules.documents import SECTION_LETTERS, question_marks, entries
+
+# Extracted data is also kept as one row per main question, question and sub-question,
+# so questions can be searched across papers without loading every documents.data blob.
+# Rows are replaced as a whole whenever a document's data is (re)written.
+LANGUAGES = ("malay", "english")
+LEVELS = ("main_question", "question", "sub_question")
+DEFAULT_SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 500
+
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def _read_content_flow(content_flow: list, malay: list, english: list, diagrams: list) -> None:
+    for item in entries(content_flow):
+        if item.get("type") == "text":
+            text = item.get("text") or {}
+            if text.get("malay"):
+                malay.append(text["malay"])
+            if text.get("english"):
+                english.append(text["english"])
+        elif item.get("type") in ("diagram", "table") and item.get("name"):
+            diagrams.append(item["name"])
+        elif item.get("type") == "row":
+            _read_content_flow(item.get("items"), malay, english, diagrams)
+
+
+def _question_row(document_id: str, section: str, main_number, number, level: str, marks, content_flow: list) -> dict:
+    malay, english, diagrams = [], [], []
+    _read_content_flow(content_flow, malay, english, diagrams)
+    return {
+        "document_id": document_id,
+        "section": section,
+        "main_number": str(main_number),
+        "number": str(number),
+        "level": level,
+        "marks": marks,
+        "text_malay": "\n".join(malay),
+        "text_english": "\n".join(english),
+        "diagrams": diagrams
+    }
+
+
+def flatten_questions(document_id: str, sections_data: list) -> list:
+    """Rows for every main question, question and sub-question of a document's extracted data."""
+    rows = []
+    for section, section_data in zip(SECTION_LETTERS, sections_data or []):
+        if not isinstance(section_data, dict):
+            continue
+        for main_question in entries(section_data.get("main_questions")):
+            main_number = main_question.get("number")
+            questions = []
+            for question in entries(main_question.get("questions")):
+                questions.append(_question_row(
+                    document_id, section, main_number, question.get("number"), "question",
+                    question_marks(question), question.get("content_flow")
+                ))
+                questions += [
+                    _question_row(
+                        document_id, section, main_number, sub.get("number"), "sub_question",
+                        parse_marks(sub.get("marks")), sub.get("content_flow")
+                    )
+                    for sub in entries(question.get("sub_questions"))
+                ]
+            marks = [row["marks"] for row in questions if row["level"] == "question" and row["marks"] is not None]
+            rows.append(_question_row(
+                document_id, section, main_number, main_number, "main_question",
+                sum(marks) if marks else None, main_question.get("content_flow")
+            ))
+            rows += questions
+    return rows
+
+
+def fts_query(text: str, language: str = None) -> str:
+    """
+    FTS5 match expression for free text: every word must occur (quoted, so punctuation and
+    FTS operators in the input are taken literally), in one language's text or in either.
+    """
+    terms = " ".join(f'"{term}"' for term in _TERM.findall(text))
+    if not terms:
+        return None
+    columns = f"text_{language}" if language else "{text_malay text_english}"
+    return f"{columns} : ({terms})"
+
+
+class SQLiteQuestionStore:
+    """Question rows in a local SQLite file with an FTS5 index over the Malay and English text."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.executescript("""
+            create table if not exists questions (
+                id integer primary key autoincrement,
+                document_id text not null,
+                section text not null,
+                main_number text not null,
+                number text not null,
+                level text not null,
+                marks integer,
+                text_malay text not null,
+                text_english text not null,
+                diagrams text not null
+            );
+            create index if not exists questions_document_idx on questions (document_id);
+            create index if not exists questions_marks_idx on questions (marks);
+            create index if not exists questions_section_idx on questions (section, main_number);
+            create virtual table if not exists questions_fts using fts5(
+                text_malay, text_english, content='questions', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            );
+            create trigger if not exists questions_fts_insert after insert on questions begin
+                insert into questions_fts (rowid, text_malay, text_english)
+                values (new.id, new.text_malay, new.text_english);
+            end;
+            create trigger if not exists questions_fts_delete after delete on questions begin
+                insert into questions_fts (questions_fts, rowid, text_malay, text_english)
+                values ('delete', old.id, old.text_malay, old.text_english);
+            end;
+        """)
+
+    def replace_document(self, document_id: str, rows: list) -> None:
+        with self._lock:
+            self._conn.execute("begin immediate")
+            try:
+                self._conn.execute("delete from questions where document_id = ?", (document_id,))
+                self._conn.executemany(
+                    "insert into questions (document_id, section, main_number, number, level, marks, "
+                    "text_malay, text_english, diagrams) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            row["document_id"], row["section"], row["main_number"], row["number"], row["level"],
+                            row["marks"], row["text_malay"], row["text_english"], json.dumps(row["diagrams"], ensure_ascii=False)
+                        )
+                        for row in rows
+                    ]
+                )
+                self._conn.execute("commit")
+            except Exception:
+                self._conn.execute("rollback")
+                raise
+
+    def search(self, query: str = None, language: str = None, min_marks: int = None, max_marks: int = None,
+               section: str = None, level: str = None, document_id: str = None, has_diagram: bool = None,
+               limit: int = DEFAULT_SEARCH_LIMIT) -> list:
+        match = fts_query(query, language) if query else None
+        if query and not match:
+            return []
+        sql = "select questions.*"
+        params = []
+        if match:
+            sql += (
+                ", snippet(questions_fts, -1, '[', ']', '…', 12) as snippet from questions "
+                "join questions_fts on questions_fts.rowid = questions.id and questions_fts match ?"
+            )
+            params.append(match)
+        else:
+            sql += " from questions"
+        conditions = []
+        for condition, value in (
+            ("marks >= ?", min_marks), ("marks <= ?", max_marks), ("section = ?", section),
+            ("level = ?", level), ("document_id = ?", document_id)
+        ):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if has_diagram is not None:
+            conditions.append("diagrams != '[]'" if has_diagram else "diagrams = '[]'")
+        if conditions:
+            sql += " where " + " and ".join(conditions)
+        sql += " order by questions_fts.rank" if match else " order by document_id, id"
+        sql += " limit ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        results = []
+        for row in rows:
+            result = dict(row)
+            del result["id"]
+            result["diagrams"] = json.loads(result["diagrams"])
+            results.append(result)
+        return results
+
+
+class SupabaseQuestionStore:
+    """
+    Question rows in the Supabase `questions` table, searched through its generated
+    tsvector columns (see README): 'simple' configuration for Malay, 'english' for English.
+    """
+
+    def __init__(self, supabase):
+        self.supabase = supabase
+
+    def replace_document(self, document_id: str, rows: list) -> None:
+        self.supabase.table("questions").delete().eq("document_id", document_id).execute()
+        if rows:
+            self.supabase.table("questions").insert(rows).execute()
+
+    def search(self, query: str = None, language: str = None, min_marks: int = None, max_marks: int = None,
+               section: str = None, level: str = None, document_id: str = None, has_diagram: bool = None,
+               limit: int = DEFAULT_SEARCH_LIMIT) -> list:
+        request = self.supabase.table("questions").select(
+            "document_id, section, main_number, number, level, marks, text_malay, text_english, diagrams"
+        )
+        if query:
+            terms = " ".join(_TERM.findall(query))
+            if not terms:
+                return []
+            if language:
+                config = "english" if language == "english" else "simple"
+                request = request.text_search(f"search_{language}", terms, {"config": config, "type": "websearch"})
+            else:
+                request = request.or_(f'search_malay.wfts(simple)."{terms}",search_english.wfts(english)."{terms}"')
+        for column, operator, value in (
+            ("marks", "gte", min_marks), ("marks", "lte", max_marks), ("section", "eq", section),
+            ("level", "eq", level), ("document_id", "eq", document_id)
+        ):
+            if value is not None:
+                request = getattr(request, operator)(column, value)
+        if has_diagram is not None:
+            request = request.neq("diagrams", "[]") if has_diagram else request.eq("diagrams", "[]")
+        return request.order("document_id").order("id").limit(limit).execute().data
+
+
+def init_question_store(supabase=None):
+    """Builds the backend selected by QUESTION_STORE_BACKEND (sqlite, supabase or none)."""
+    backend = os.getenv("QUESTION_STORE_BACKEND", "sqlite").lower()
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        return SQLiteQuestionStore(os.getenv("QUESTION_STORE_PATH") or "cache/questions.sqlite3")
+    if backend == "supabase":
+        return SupabaseQuestionStore(supabase)
+    raise ValueError(f"Unknown QUESTION_STORE_BACKEND: {backend}")
@@ -1,30 +1,85 @@
-import json
+import os
+import time
 import logging
+import threading
+from functools import lru_cache
+from types import MappingProxyType
+
+from models.schema import Text, Diagram, Row, Table, AnswerSpace, TypeSubQuestion, TypeQuestion
+
+# Bump whenever the extraction or section prompts change, so cached results are not reused
+PROMPT_VERSION = "3"
+
+# "reference": the prompt carries a reference JSON and the reference PDF;
+# "schema": the response is constrained to models.schema.Section at generation time
+EXTRACTION_MODES = ("reference", "schema")
+
+REFERENCE_SECTIONS = MappingProxyType({
+    'Section A': MappingProxyType({'file': 'reference_files/with_sections/reference_output_A.json', 'start_page': 4, 'end_page': 26}),
+    'Section B': MappingProxyType({'file': 'reference_files/with_sections/reference_output_B.json', 'start_page': 27, 'end_page': 32}),
+    'Section C': MappingProxyType({'file': 'reference_files/with_sections/reference_output_C.json', 'start_page': 33, 'end_page': 35})
+})
+
+# Reference structures are read once and kept in memory; the file's mtime is re-checked
+# at most every REFERENCE_RELOAD_CHECK_SECONDS so edits are still picked up.
+_reference_lock = threading.Lock()
+_reference_structures = {}
+
+def get_reference_structure(path: str) -> str:
+    now = time.monotonic()
+    cached = _reference_structures.get(path)
+    if cached and now - cached["checked_at"] < float(os.getenv("REFERENCE_RELOAD_CHECK_SECONDS", 5)):
+        return cached["content"]
+
+    with _reference_lock:
+        try:
+            mtime = os.path.getmtime(path)
+            cached = _reference_structures.get(path)
+            if not cached or cached["mtime"] != mtime:
+                with open(path, 'r', encoding='utf-8') as f:
+                    cached = {"mtime": mtime, "content": f.read()}
+            _reference_structures[path] = {**cached, "checked_at": now}
+        except FileNotFoundError:
+            raise ValueError(f"Reference file not found: {path}")
+    return cached["content"]
+
+def load_reference_structures() -> None:
+    """Warms the reference structure cache, e.g. at startup."""
+    for reference_config in REFERENCE_SECTIONS.values():
+        get_reference_structure(reference_config['file'])
+
+def get_extraction_mode() -> str:
+    mode = os.getenv("EXTRACTION_MODE", "reference")
+    if mode not in EXTRACTION_MODES:
+        raise ValueError(f"Unknown extraction mode: {mode}")
+    return mode
+
+def get_question_range(section_name: str) -> str:
+    if section_name == 'Bahagian A' or section_name == 'Section A':
+        return "1-8"
+    elif section_name == 'Bahagian B' or section_name == 'Section B':
+        return "9-10"
+    elif section_name == 'Bahagian C' or section_name == 'Section C':
+        return "11"
+    return ""
 
 def build_extract_section_data_prompt(section_info: dict):
-    reference_sections = {
-        'Section A': {'file': 'reference_files/with_sections/reference_output_A.json', 'start_page': 4, 'end_page': 26},
-        'Section B': {'file': 'reference_files/with_sections/reference_output_B.json', 'start_page': 27, 'end_page': 32},
-        'Section C': {'file': 'reference_files/with_sections/reference_output_C.json', 'start_page': 33, 'end_page': 35}
-    }
-    reference_config = reference_sections.get(section_info['name'])
+    reference_config = REFERENCE_SECTIONS.get(section_info['name'])
     
     if not reference_config:
         raise ValueError(f"Unknown section name: {section_info['name']}")
-        
-    try:
-        with open(reference_config['file'], 'r', encoding='utf-8') as f:
-            reference_structure = f.read()
-    except FileNotFoundError:
-        raise ValueError(f"Reference file not found: {reference_config['file']}")
-
-    question_range = ""
-    if section_info['name'] == 'Bahagian A' or section_info['name'] == 'Section A':
-        question_range = "1-8"
-    elif section_info['name'] == 'Bahagian B' or section_info['name'] == 'Section B':
-        question_range = "9-10"
-    elif section_info['name'] == 'Bahagian C' or section_info['name'] == 'Section C':
-        question_range = "11"
+
+    reference_structure = get_reference_structure(reference_config['file'])
+    return _render_section_prompt(
+        section_info['name'], section_info['start_page'], section_info['end_page'], reference_structure
+    )
+
+# Rendered prompts only depend on these arguments, so identical sections reuse the same string
+@lru_cache(maxsize=256)
+def _render_section_prompt(section_name: str, start_page: int, end_page: int, reference_structure: str) -> str:
+    section_info = {'name': section_name, 'start_page': start_page, 'end_page': end_page}
+
+    question_range = get_question_range(section_info['name'])
 
     section_prompt = f"""
         You are an Exam Paper Structure Extractor. Your task is to create a valid JSON structure from the PDF content.
@@ -59,6 +114,7 @@ def build_extract_section_data_prompt(section_info: dict):
         - NO explanations or markdown
         - NO extra backslashes
         - Each question should appear in exactly ONE place in the hierarchy
+        - For every diagram and table, "page" is the page position in the provided PDF (its first page is 1)
         - Verify all brackets and braces are properly matched
         - Ensure all required commas are present between elements
         - Use the reference structure but fill with PDF content only
@@ -68,43 +124,191 @@ def build_extract_section_data_prompt(section_info: dict):
     """
     return section_prompt
 
-# Validate if Sections A, B, C has all the required questions
-def validate_section_content(section_data: str, section_name: str) -> None:
-    # Validate section content meets requirements.
-    try:
-        # Parse the JSON string into a dictionary
-        data = json.loads(section_data)
-        
-        if section_name in ['Bahagian A', 'Section A']:
-            # Check number of main questions
-            main_questions = data.get('main_questions', [])
-            question_numbers = [str(q.get('number')) for q in main_questions]  # Convert to strings
-            expected_numbers = [str(i) for i in range(1, 9)]  # 1 to 8
-            
-            missing = set(expected_numbers) - set(question_numbers)
-            if missing:
-                logging.warning(f"Section A is missing questions: {', '.join(missing)}")
-                # No longer raising an error, just logging a warning
-        
-        if section_name in ['Bahagian B', 'Section B']:
-            # Check number of main questions
-            main_questions = data.get('main_questions', [])
-            question_numbers = [str(q.get('number')) for q in main_questions]
-            expected_numbers = [str(i) for i in range(9, 11)]  # 9 to 10
-            
-            missing = set(expected_numbers) - set(question_numbers)
-            if missing:
-                logging.warning(f"Section B is missing questions: {', '.join(missing)}")
-        
-        if section_name in ['Bahagian C', 'Section C']:
-            # Check number of main questions
-            main_questions = data.get('main_questions', [])
-            question_numbers = [str(q.get('number')) for q in main_questions]
-            expected_numbers = ['11']
-            missing = set(expected_numbers) - set(question_numbers)
-            if missing:
-                logging.warning(f"Section C is missing questions: {', '.join(missing)}")
-    except json.JSONDecodeError as e:
-        logging.error(f"Invalid JSON format: {str(e)}")
-        # Still raise error for invalid JSON as this is a critical error
-        raise
+@lru_cache(maxsize=256)
+def build_extract_section_schema_prompt(section_name: str, start_page: int, end_page: int) -> str:
+    """
+    Prompt for schema mode. The JSON shape is enforced by the response schema,
+    so only the content rules are spelled out here.
+    """
+    return f"""
+        You are an Exam Paper Structure Extractor. Extract {section_name}, Pages {start_page} to {end_page}
+        of the provided PDF, questions {get_question_range(section_name)}.
+
+        REQUIREMENTS:
+        - Use ONLY content from the provided PDF, in reading order
+        - Each question should appear in exactly ONE place in the hierarchy
+        - Keep the original Malay text in "malay" and give the English text in "english" when the paper has it
+        - Content that sits side by side goes in a "row" item with its "items"
+        - For every diagram and table, "page" is the page position in the provided PDF (its first page is 1)
+        - "marks" is the number in the mark annotation, e.g. [2 markah] is 2
+    """
+
+def build_continuation_prompt(partial_text: str) -> str:
+    return f"""
+        Your previous answer was cut off. It ends with:
+        {partial_text[-200:]}
+
+        Continue the JSON from exactly after the last character above.
+        Output ONLY the remaining characters: do not repeat anything, do not start over, no markdown.
+    """
+
+# Required keys of each content_flow item type, taken from models.schema
+CONTENT_FLOW_FIELDS = MappingProxyType({
+    item_class.model_fields["type"].annotation.__args__[0].value: frozenset(
+        name for name, field in item_class.model_fields.items() if field.is_required()
+    )
+    for item_class in (Text, Diagram, Row, Table, AnswerSpace, TypeSubQuestion, TypeQuestion)
+})
+
+def get_expected_main_questions(section_name: str) -> list:
+    question_range = get_question_range(section_name)
+    if not question_range:
+        return []
+    first, _, last = question_range.partition("-")
+    return [str(number) for number in range(int(first), int(last or first) + 1)]
+
+def parse_marks(value):
+    """
+    Marks as an int: model output sometimes has them as strings ("2") or floats (2.0).
+    None when there are no marks or they are not a whole number.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+def _entries(items, owner: str, kind: str, problems: list) -> list:
+    """The dict entries of a question list; anything else is recorded as a problem and skipped."""
+    if items is None:
+        return []
+    if not isinstance(items, list):
+        problems.append(f"{owner} has {kind} that are not a list")
+        return []
+    entries = [item for item in items if isinstance(item, dict)]
+    if len(entries) < len(items):
+        problems.append(f"{owner} has {kind} that are not objects")
+    return entries
+
+def _checked_marks(entry: dict, owner: str, problems: list):
+    """An entry's marks as an int, recording marks that are present but not a whole number."""
+    marks = parse_marks(entry.get("marks"))
+    if marks is None and entry.get("marks") is not None:
+        problems.append(f"{owner} has invalid marks: {entry['marks']!r}")
+    return marks
+
+def validate_section(data, section_name: str) -> list:
+    """
+    Checks a parsed section against the hierarchy in models.schema in a single walk:
+    expected main questions, duplicate or nested questions, content_flow references
+    to questions and sub-questions that exist, and marks against section_marks.
+    Problems are logged as warnings and returned.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("main_questions"), list):
+        logging.warning(f"{section_name}: main_questions is missing")
+        return ["main_questions is missing"]
+
+    problems = []
+    main_numbers = set()
+    main_totals = []
+    for main_question in _entries(data["main_questions"], "section", "main_questions", problems):
+        number = str(main_question.get("number"))
+        if number in main_numbers:
+            problems.append(f"main question {number} appears more than once")
+        main_numbers.add(number)
+        if "main_questions" in main_question:
+            problems.append(f"main question {number} contains nested main_questions")
+
+        questions = _entries(main_question.get("questions"), f"main question {number}", "questions", problems)
+        question_numbers = [str(question.get("number")) for question in questions]
+        references = _check_content_flow(main_question.get("content_flow"), f"main question {number}", "question", problems)
+        _check_references(references, question_numbers, f"main question {number}", "question", problems)
+
+        total = 0
+        seen = set()
+        for question, question_number in zip(questions, question_numbers):
+            if question_number in seen:
+                problems.append(f"question {question_number} appears more than once")
+            seen.add(question_number)
+            if "questions" in question:
+                problems.append(f"question {question_number} contains nested questions")
+
+            sub_questions = _entries(question.get("sub_questions"), f"question {question_number}", "sub_questions", problems)
+            sub_numbers = [str(sub_question.get("number")) for sub_question in sub_questions]
+            if len(set(sub_numbers)) < len(sub_numbers):
+                problems.append(f"question {question_number} has duplicate sub-questions")
+            references = _check_content_flow(question.get("content_flow"), f"question {question_number}", "sub_question", problems)
+            _check_references(references, sub_numbers, f"question {question_number}", "sub_question", problems)
+            sub_marks = []
+            for sub_question, sub_number in zip(sub_questions, sub_numbers):
+                if "sub_questions" in sub_question:
+                    problems.append(f"sub-question {sub_number} contains nested sub_questions")
+                _check_content_flow(sub_question.get("content_flow"), f"sub-question {sub_number}", None, problems)
+                sub_marks.append(_checked_marks(sub_question, f"sub-question {sub_number}", problems))
+
+            marks = _checked_marks(question, f"question {question_number}", problems)
+            if total is None:
+                continue
+            if marks is not None:
+                total += marks
+            elif sub_marks and None not in sub_marks:
+                total += sum(sub_marks)
+            else:
+                total = None
+        # totals are only compared when every question's marks are known
+        if total is None or main_totals is None:
+            main_totals = None
+        else:
+            main_totals.append(total)
+
+    missing = [number for number in get_expected_main_questions(section_name) if number not in main_numbers]
+    if missing:
+        problems.append(f"missing main questions: {', '.join(missing)}")
+
+    # sections where candidates answer one of several questions (e.g. Bahagian B) give
+    # every main question the full section marks
+    section_marks = parse_marks(data.get("section_marks"))
+    if section_marks and main_totals:
+        if sum(main_totals) != section_marks and any(total != section_marks for total in main_totals):
+            problems.append(f"question marks add up to {sum(main_totals)}, section_marks is {section_marks}")
+    for problem in problems:
+        logging.warning(f"{section_name}: {problem}")
+    return problems
+
+def _check_content_flow(content_flow, owner: str, reference_type, problems: list) -> list:
+    """Checks content_flow items (and row items) and returns the numbers referenced with reference_type."""
+    if not isinstance(content_flow, list):
+        problems.append(f"{owner} has no content_flow")
+        return []
+    references = []
+    pending = list(content_flow)
+    while pending:
+        item = pending.pop()
+        item_type = item.get("type") if isinstance(item, dict) else None
+        fields = CONTENT_FLOW_FIELDS.get(item_type)
+        if fields is None:
+            problems.append(f"{owner} has an unknown content_flow item: {item_type}")
+            continue
+        if not fields.issubset(item):
+            problems.append(f"{owner} has a {item_type} item without {', '.join(sorted(fields - item.keys()))}")
+            continue
+        if item_type == "row":
+            pending.extend(item["items"])
+        elif item_type in ("question", "sub_question"):
+            if item_type != reference_type:
+                problems.append(f"{owner} refers to {item_type} {item['number']} inside itself")
+            else:
+                references.append(str(item["number"]))
+    references.reverse()
+    return references
+
+def _check_references(references: list, numbers: list, owner: str, reference_type: str, problems: list) -> None:
+    known = set(numbers)
+    for number in dict.fromkeys(number for number in references if number not in known):
+        problems.append(f"{owner} refers to {reference_type} {number}, which is not in its list")
+    if len(set(references)) < len(references):
+        problems.append(f"{owner} refers to the same {reference_type} more than once")
@@ -1,5 +1,80 @@
+import re
+import json
+import asyncio
+from collections import Counter
 from datetime import datetime
-from modules.utils import get_last_page  
+
+import fitz
+
+from modules.utils import get_last_page, open_pdf
+from modules.layout import HEADER_FRACTION, FOOTER_FRACTION
+from config.ai_client import get_ai_response_async, upload_pdf, delete_pdf
+from config.metrics import stage
+
+SECTION_HEADER = re.compile(r"(?:Bahagian|Section)\s+([ABC])$", re.IGNORECASE)
+SECTION_MARKS = re.compile(r"\[\s*\d+\s*(?:markah|marks?)\s*\]$", re.IGNORECASE)
+PRINTED_PAGE_NUMBER = re.compile(r"\d{1,3}$")
+# local detection is trusted when this many numbered pages, and this share of them, agree on the offset
+MIN_NUMBERED_PAGES = 3
+MIN_OFFSET_AGREEMENT = 0.6
+
+def detect_section_pages(pdf_content):
+    """
+    Finds where Bahagian/Section A, B and C start and the first printed page number from
+    the text layer of a PDF (bytes or file path), without a model call. Returns the same shape as the answer to
+    build_identify_sections_prompt, or None when the result is not certain (scanned
+    papers, missing or ambiguous headers, inconsistent page numbers).
+    """
+    doc = open_pdf(pdf_content)
+    offsets = Counter()
+    # letter -> [(page index, header followed by a "[20 markah]" line)]
+    candidates = {"A": [], "B": [], "C": []}
+    try:
+        for index, page in enumerate(doc):
+            top = page.rect.height * HEADER_FRACTION
+            bottom = page.rect.height * FOOTER_FRACTION
+            body_lines = []
+            for x0, y0, x1, y1, text, *_ in page.get_text("blocks", flags=fitz.TEXTFLAGS_TEXT):
+                lines = [line.strip() for line in text.splitlines() if line.strip()]
+                if y1 <= top or y0 >= bottom:
+                    for line in lines:
+                        if PRINTED_PAGE_NUMBER.match(line):
+                            offsets[int(line) - index - 1] += 1
+                else:
+                    body_lines.extend(lines)
+
+            for position, line in enumerate(body_lines):
+                match = SECTION_HEADER.match(line)
+                if match:
+                    followed_by_marks = any(SECTION_MARKS.match(next_line) for next_line in body_lines[position + 1:position + 3])
+                    candidates[match.group(1).upper()].append((index, followed_by_marks))
+    finally:
+        doc.close()
+
+    numbered_pages = sum(offsets.values())
+    if numbered_pages < MIN_NUMBERED_PAGES:
+        return None
+    offset, agreeing = offsets.most_common(1)[0]
+    if agreeing / numbered_pages < MIN_OFFSET_AGREEMENT:
+        return None
+
+    start_indices = {}
+    previous = -1
+    for letter, found in candidates.items():
+        after_previous = [(index, has_marks) for index, has_marks in found if index > previous]
+        with_marks = [index for index, has_marks in after_previous if has_marks]
+        if with_marks:
+            previous = with_marks[0]
+        elif len(after_previous) == 1:
+            previous = after_previous[0][0]
+        else:
+            return None
+        start_indices[letter] = previous
+
+    return {
+        "sections": {letter: index + offset + 1 for letter, index in start_indices.items()},
+        "first_page_number": offset + 1
+    }
 
 def build_identify_sections_prompt():
     return f"""
@@ -43,6 +118,8 @@ async def identify_sections(response, pdf_content):
             {"name": "Section B", "start_page": start_B, "end_page": start_C - 1},
             {"name": "Section C", "start_page": start_C, "end_page": last_page}
         ]
+        for section in sections_data:
+            section["page_offset"] = offset
 
         # Normalize section names and print section info
         for section in sections_data:
@@ -83,3 +160,26 @@ async def identify_sections(response, pdf_content):
             # f.write(f"Model response:\n{response.text}")
             
         raise ValueError(f"Failed to identify sections properly: {str(e)}. See {error_log_name} for details")
+
+async def locate_sections(pdf_path: str, fair_key=None) -> list:
+    """
+    Section list (names, page ranges, page offset) of a PDF on disk. Section headers and page
+    numbers are read from the text layer; the model is only asked when that is not conclusive
+    (e.g. scanned papers).
+    """
+    with stage("section_detection"):
+        sections_response_json = await asyncio.to_thread(detect_section_pages, pdf_path)
+    if sections_response_json is None:
+        with stage("section_identification"):
+            # sent through the File API from disk rather than as an inline base64 copy
+            pdf = await asyncio.to_thread(upload_pdf, pdf_path)
+            try:
+                print("Identifying sections...")
+                sections_response = await get_ai_response_async(
+                    [pdf, build_identify_sections_prompt()], fair_key=fair_key, section="identify_sections"
+                )
+            finally:
+                # the user's paper is only needed for this one call
+                await asyncio.to_thread(delete_pdf, pdf)
+            sections_response_json = json.loads(sections_response.text)
+    return await identify_sections(sections_response_json, pdf_path)
@@ -0,0 +1,233 @@
+import os
+import asyncio
+import hashlib
+import zipfile
+import tempfile
+
+import fitz
+import python_multipart
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import parse_options_header
+
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# the PDF header may be preceded by junk, but has to be within the first kilobyte
+PDF_MAGIC = b"%PDF-"
+ZIP_MAGIC = b"PK\x03\x04"
+MAGIC_SEARCH_BYTES = 1024
+# room for the multipart boundaries and part headers around the files themselves
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadRejected(ValueError):
+    """An upload that is not accepted; status_code is the HTTP status to answer with."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Spool:
+    """A temporary file filled chunk by chunk, hashed and size-checked on the way."""
+
+    def __init__(self, max_bytes: int, kind: str = "pdf"):
+        self.max_bytes = max_bytes
+        self.kind = kind
+        self.digest = hashlib.sha256()
+        self.size = 0
+        # the first bytes are held back until there are enough to look for the file's magic
+        self.head = b""
+        fd, self.path = tempfile.mkstemp(prefix="upload_", suffix=f".{kind}")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        if self.head is not None:
+            self.head += chunk
+            if len(self.head) < MAGIC_SEARCH_BYTES:
+                return
+            chunk, self.head = self.head, None
+            self._check_magic(chunk)
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadRejected(413, f"{self.kind.upper()} is larger than {self.max_bytes} bytes")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def _check_magic(self, head: bytes) -> None:
+        if self.kind == "pdf" and PDF_MAGIC not in head[:MAGIC_SEARCH_BYTES]:
+            raise UploadRejected(400, "Uploaded file is not a PDF")
+        if self.kind == "zip" and not head.startswith(ZIP_MAGIC):
+            raise UploadRejected(400, "Uploaded file is not a zip archive")
+
+    def close(self) -> dict:
+        if self.head:
+            head, self.head = self.head, None
+            self._check_magic(head)
+            self.write(head)
+        self.file.close()
+        if self.size == 0:
+            raise UploadRejected(400, "Uploaded file is empty")
+        return {"path": self.path, "sha256": self.digest.hexdigest(), "size": self.size}
+
+    def discard(self) -> None:
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def check_content_length(request, max_bytes: int) -> None:
+    """Rejects a request whose declared body is larger than max_bytes of files, before any of it is read."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES:
+        raise UploadRejected(413, f"Upload is larger than {max_bytes} bytes")
+
+
+async def spool_form_files(request, field: str, file_limits) -> list:
+    """
+    Reads a multipart/form-data request body as it arrives and writes every file sent as
+    `field` straight to its own temporary file, hashed and size-checked on the way. An
+    oversized upload is cut off while it is received, and nothing else holds a copy of it.
+    file_limits(file name) returns (max bytes, "pdf" or "zip") for a file, or raises UploadRejected.
+    Returns (file name, {"path", "sha256", "size"}) pairs; the caller removes the files.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadRejected(400, "Expected a multipart/form-data upload")
+
+    spools = []
+    # file data received since the last write, written in a thread after each chunk
+    pending = []
+    part = {}
+
+    def on_part_begin():
+        part.update(header_name=b"", header_value=b"", disposition=b"", spool=None)
+
+    def on_header_field(data: bytes, start: int, end: int):
+        part["header_name"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        part["header_value"] += data[start:end]
+
+    def on_header_end():
+        if part["header_name"].lower() == b"content-disposition":
+            part["disposition"] = part["header_value"]
+        part["header_name"] = part["header_value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(part["disposition"])
+        # other fields and their values are ignored
+        if options.get(b"name") == field.encode() and b"filename" in options:
+            file_name = options[b"filename"].decode("utf-8", "replace")
+            part["spool"] = _Spool(*file_limits(file_name))
+            spools.append((file_name, part["spool"]))
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if part["spool"] is not None:
+            pending.append((spools[-1][0], part["spool"], data[start:end]))
+
+    def write_pending(chunks: list) -> None:
+        for file_name, spool, data in chunks:
+            try:
+                spool.write(data)
+            except UploadRejected as e:
+                raise UploadRejected(e.status_code, f"{file_name}: {str(e)}")
+
+    def close_all() -> list:
+        closed = []
+        for file_name, spool in spools:
+            try:
+                closed.append((file_name, spool.close()))
+            except UploadRejected as e:
+                raise UploadRejected(e.status_code, f"{file_name}: {str(e)}")
+        return closed
+
+    parser = python_multipart.MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            chunks = pending[:]
+            pending.clear()
+            await asyncio.to_thread(write_pending, chunks)
+        parser.finalize()
+        return await asyncio.to_thread(close_all)
+    except BaseException as e:
+        for _, spool in spools:
+            spool.discard()
+        if isinstance(e, FormParserError):
+            raise UploadRejected(400, f"Invalid multipart data: {str(e)}")
+        raise
+
+
+def form_files_openapi(field: str, multiple: bool = False) -> dict:
+    """OpenAPI request body for endpoints that read their files with spool_form_files."""
+    schema = {"type": "string", "format": "binary"}
+    if multiple:
+        schema = {"type": "array", "items": schema}
+    return {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+        "type": "object", "required": [field], "properties": {field: schema}
+    }}}}}
+
+
+def extract_zip_pdfs(zip_path: str, max_bytes: int, max_files: int) -> list:
+    """
+    Spools every PDF in a zip archive to its own temporary file, with the same checks as
+    uploaded PDFs. Returns (file name, spooled upload) pairs; the caller removes the files.
+    """
+    spooled = []
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            members = [
+                member for member in archive.infolist()
+                if not member.is_dir() and member.filename.lower().endswith(".pdf")
+                # resource forks added by macOS are not papers
+                and not member.filename.startswith("__MACOSX/") and not os.path.basename(member.filename).startswith("._")
+            ]
+            if not members:
+                raise UploadRejected(400, f"{os.path.basename(zip_path)} contains no PDF files")
+            if len(members) > max_files:
+                raise UploadRejected(413, f"Zip has {len(members)} PDFs, at most {max_files} are accepted")
+            for member in members:
+                name = os.path.basename(member.filename)
+                # the declared size can lie, so _Spool also counts what is actually inflated
+                if member.file_size > max_bytes:
+                    raise UploadRejected(413, f"{name} is larger than {max_bytes} bytes")
+                spool = _Spool(max_bytes)
+                try:
+                    with archive.open(member) as pdf_stream:
+                        while chunk := pdf_stream.read(UPLOAD_CHUNK_BYTES):
+                            spool.write(chunk)
+                    spooled.append((name, spool.close()))
+                except UploadRejected as e:
+                    spool.discard()
+                    raise UploadRejected(e.status_code, f"{name}: {str(e)}")
+                except BaseException:
+                    spool.discard()
+                    raise
+    except BaseException as e:
+        for _, upload in spooled:
+            os.remove(upload["path"])
+        if isinstance(e, zipfile.BadZipFile):
+            raise UploadRejected(400, f"Zip archive could not be read: {str(e)}")
+        raise
+    return spooled
+
+
+def check_pdf(path: str, max_pages: int) -> int:
+    """Opens a spooled PDF from disk (MuPDF reads it lazily) and returns its page count."""
+    try:
+        doc = fitz.open(path, filetype="pdf")
+    except Exception as e:
+        raise UploadRejected(400, f"PDF could not be opened: {str(e)}")
+    try:
+        pages = len(doc)
+    finally:
+        doc.close()
+    if pages > max_pages:
+        raise UploadRejected(413, f"PDF has {pages} pages, at most {max_pages} are accepted")
+    return pages
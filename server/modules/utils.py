@@ -1,19 +1,109 @@
 import fitz
 import os
+import random
+import threading
+from datetime import datetime, timedelta, timezone
 
-def get_last_page(pdf_content: bytes) -> int:
-    """Returns the last page number of a PDF."""
-    doc = fitz.open(stream=pdf_content, filetype="pdf")  # Open PDF from bytes
+from config.ai_client import upload_pdf, convert_pdf_to_part
+
+REFERENCE_PDF_PATH = 'reference_files/reference_input.pdf'
+
+def open_pdf(pdf):
+    """Opens a PDF given as bytes or as a file path (read from disk on demand)."""
+    if isinstance(pdf, (bytes, bytearray)):
+        return fitz.open(stream=pdf, filetype="pdf")
+    return fitz.open(pdf, filetype="pdf")
+
+def get_last_page(pdf_content) -> int:
+    """Returns the last page number of a PDF (bytes or file path)."""
+    doc = open_pdf(pdf_content)
     last_page = len(doc)  # Get total page count
     doc.close()
     return last_page
 
+def section_page_indices(doc, start_page: int, end_page: int, page_offset: int = 0, context_pages: int = 0) -> list:
+    """0-based indices in an open fitz document of printed pages start_page..end_page, plus context_pages on each side."""
+    first_index = max(start_page - page_offset - 1 - context_pages, 0)
+    last_index = min(end_page - page_offset - 1 + context_pages, len(doc) - 1)
+    if first_index > last_index:
+        raise ValueError(f"Pages {start_page}-{end_page} are outside the document")
+    return list(range(first_index, last_index + 1))
+
+def slice_pdf_pages(doc, indices: list, page_offset: int = 0):
+    """
+    Copies the pages at the given 0-based indices of an open fitz document into a new PDF.
+    Returns the PDF bytes and a mapping from page position in the slice (1-based) to the
+    printed page number in the original document.
+    """
+    sliced = fitz.open()
+    # copy runs of consecutive pages in one call each
+    run_start = 0
+    for position in range(1, len(indices) + 1):
+        if position == len(indices) or indices[position] != indices[position - 1] + 1:
+            sliced.insert_pdf(doc, from_page=indices[run_start], to_page=indices[position - 1])
+            run_start = position
+    pdf_bytes = sliced.tobytes(garbage=3, deflate=True)
+    sliced.close()
+
+    page_map = {position: index + page_offset + 1 for position, index in enumerate(indices, start=1)}
+    return pdf_bytes, page_map
+
+def remap_pages(data, page_map: dict):
+    """Rewrites diagram/table "page" values from slice positions back to original page numbers."""
+    if isinstance(data, dict):
+        if data.get("type") in ("diagram", "table") and isinstance(data.get("page"), int):
+            data["page"] = page_map.get(data["page"], data["page"])
+        for value in data.values():
+            remap_pages(value, page_map)
+    elif isinstance(data, list):
+        for item in data:
+            remap_pages(item, page_map)
+    return data
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter for a 1-based attempt number."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
 def get_reference_pdf() -> str:
     """Get the reference PDF content."""
-    reference_pdf_path = 'reference_files/reference_input.pdf'
+    reference_pdf_path = REFERENCE_PDF_PATH
     
     if not os.path.exists(reference_pdf_path):
         raise ValueError(f"Reference PDF not found: {reference_pdf_path}")
         
     with open(reference_pdf_path, 'rb') as f:
-        return f.read()
\ No newline at end of file
+        return f.read()
+
+# The reference PDF is the same for every job, so it is uploaded to the File API
+# once and the handle is reused until shortly before it expires. If the upload
+# fails we fall back to sending the bytes inline and try again after a cooldown.
+_reference_lock = threading.Lock()
+_reference_part = {"part": None, "expires_at": None, "inline": None, "retry_at": None}
+
+def get_reference_pdf_part():
+    """Returns a reusable model part for the reference PDF (uploaded handle or inline bytes)."""
+    now = datetime.now(timezone.utc)
+    with _reference_lock:
+        cached = _reference_part
+        if cached["part"] is not None and cached["expires_at"] > now:
+            return cached["part"]
+
+        if cached["retry_at"] is None or cached["retry_at"] <= now:
+            try:
+                uploaded = upload_pdf(REFERENCE_PDF_PATH)
+                ttl = timedelta(hours=float(os.getenv("REFERENCE_PDF_TTL_HOURS", 24)))
+                expires_at = now + ttl
+                # the File API deletes uploads after 48h; refresh a little earlier than that
+                expiration_time = getattr(uploaded, "expiration_time", None)
+                if expiration_time is not None:
+                    expires_at = min(expires_at, expiration_time - timedelta(minutes=10))
+                cached.update(part=uploaded, expires_at=expires_at, retry_at=None)
+                print(f"Uploaded reference PDF as {uploaded.name} (reuse until {expires_at.isoformat()})")
+                return uploaded
+            except Exception as e:
+                print(f"Reference PDF upload failed, sending it inline: {str(e)}")
+                cached.update(part=None, expires_at=None, retry_at=now + timedelta(minutes=5))
+
+        if cached["inline"] is None:
+            cached["inline"] = convert_pdf_to_part(get_reference_pdf())
+        return cached["inline"]
@@ -0,0 +1,54 @@
+import asyncio
+import argparse
+import multiprocessing
+from dotenv import load_dotenv
+
+from modules.jobs import init_job_queue, run_worker
+from modules.questions import load_reference_structures
+from modules.cache import init_cache
+from modules.question_store import init_question_store
+from modules import events
+
+from config.metrics import serve_metrics, configure_logging
+
+from db.init import init_db
+
+def run_process(concurrency: int, poll_interval: float, metrics_port: int = None):
+    load_dotenv()
+    configure_logging()
+    if metrics_port:
+        serve_metrics(metrics_port)
+    supabase = init_db()
+    result_cache = init_cache(supabase)
+    job_queue = init_job_queue(supabase)
+    question_store = init_question_store(supabase)
+    # inserts run on a background thread so extraction never waits on the event log
+    events.add_sink(events.BackgroundSink(job_queue.add_event))
+    load_reference_structures()
+    asyncio.run(run_worker(job_queue, supabase, result_cache, concurrency, poll_interval, question_store))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs extraction workers for queued documents.")
+    parser.add_argument("--processes", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--concurrency", type=int, default=2, help="jobs run at the same time per process")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="seconds between polls when idle")
+    parser.add_argument(
+        "--metrics-port", type=int, default=None,
+        help="serve /metrics from each process on this port (+ process index); not needed with PROMETHEUS_MULTIPROC_DIR"
+    )
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_process(args.concurrency, args.poll_interval, args.metrics_port)
+    else:
+        processes = [
+            multiprocessing.Process(
+                target=run_process,
+                args=(args.concurrency, args.poll_interval, args.metrics_port + index if args.metrics_port else None)
+            )
+            for index in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()